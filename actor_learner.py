@@ -0,0 +1,199 @@
+import queue
+import time
+import torch
+import torch.multiprocessing as mp
+from typing import Callable
+from agent import Agent, InferenceEngine
+from base import Base
+from environment import Environment
+from replay_buffer import TransitionBatch, NStepWindow
+from strategy import Strategy
+from trainer import Trainer
+
+
+class SharedWeights:
+
+    def __init__(self, network: torch.nn.Module) -> None:
+        """
+        Floating point parameters and buffers of `network`, flattened into one shared memory tensor.
+        Processes that receive this object map the same memory, so publishing is a copy and nothing is pickled.
+
+        `version` works as a seqlock. It is odd while a publish is in progress,
+        readers retry when it changed under them.
+        """
+        tensors = self.tensors(network)
+        self.numels = [t.numel() for t in tensors]
+        self.flat = torch.zeros(sum(self.numels)).share_memory_()
+        self.version = torch.zeros(1, dtype=torch.long).share_memory_()
+        self.publish(network)
+
+    @staticmethod
+    def tensors(network: torch.nn.Module) -> list[torch.Tensor]:
+        return [t for t in network.state_dict().values() if t.is_floating_point()]
+
+    @property
+    def published(self) -> int:
+        return int(self.version) // 2
+
+    def publish(self, network: torch.nn.Module) -> None:
+        self.version += 1
+        with torch.no_grad():
+            for view, t in zip(self.flat.split(self.numels), self.tensors(network)):
+                view.copy_(t.flatten())
+        self.version += 1
+
+    def pull(self, network: torch.nn.Module, published: int = -1) -> int:
+        """Loads the weights into `network` if they changed since `published`, returns what was loaded"""
+        while True:
+            version = int(self.version)
+            if version // 2 == published:
+                return published
+            if version % 2:
+                time.sleep(0)
+                continue
+            with torch.no_grad():
+                for view, t in zip(self.flat.split(self.numels), self.tensors(network)):
+                    t.copy_(view.view_as(t))
+            if int(self.version) == version:
+                return version // 2
+
+
+def actor(
+    make_env: Callable[[], Environment],
+    make_network: Callable[[], torch.nn.Module],
+    strategy: Strategy,
+    weights: SharedWeights,
+    transitions: mp.Queue,
+    chunk: int,
+    sync_interval: int,
+    n_step: int = 1,
+    gamma: float = None,
+    seed: int = 0,
+    make_engine: Callable[[torch.nn.Module], InferenceEngine] = None
+) -> None:
+    """
+    Acts with its own `Agent` and environment, and sends transitions to the learner
+    in chunks of `chunk` rows, tagged with the weights version they were collected with,
+    along with the returns of the episodes that ended meanwhile.
+    Pulls new weights every `sync_interval` steps. n-step returns are computed here.
+    With `make_engine`, acts through an engine built from the network, refreshed on every new version.
+    """
+    torch.set_num_threads(1)
+    torch.manual_seed(seed)
+    env = make_env()
+    network = make_network()
+    agent = Agent(network, strategy, make_engine(network) if make_engine else None)
+    agent.reset()
+    published = weights.pull(agent.network)
+    agent.refresh()
+    window = NStepWindow(n_step, gamma) if n_step > 1 else None
+
+    pending : list[TransitionBatch] = []
+    returns : list[float] = []
+    ep_return = 0.0
+    state = env.reset()
+    steps = 0
+    while True:
+        steps += 1
+        if steps % sync_interval == 0:
+            pulled = weights.pull(agent.network, published)
+            if pulled != published:
+                agent.refresh()
+            published = pulled
+
+        action = agent.step(state)
+        next_state, r, done = env.step(action)
+        x = TransitionBatch(state, action, r, next_state, done)
+        pending.extend(window.push(x) if window else [x])
+        state = next_state
+        ep_return += r.item()
+
+        if done.item():
+            if window:
+                pending.extend(window.flush())
+            state = env.reset()
+            returns.append(ep_return)
+            ep_return = 0.0
+
+        if len(pending) >= chunk:
+            transitions.put((TransitionBatch.cat(pending), published, returns))
+            pending = []
+            returns = []
+
+
+class Learner(Base):
+
+    def __init__(
+        self,
+        trainer: Trainer,
+        transitions: mp.Queue,
+        weights: SharedWeights,
+        publish_interval: int
+    ) -> None:
+        """
+        Trains continuously on what the actors send, and publishes weights every `publish_interval` steps.
+        Staleness is how many publishes behind the weights were, when a transition was collected.
+        """
+        self.trainer = trainer
+        self.transitions = transitions
+        self.weights = weights
+        self.publish_interval = publish_interval
+        self.reset()
+
+    def step(self) -> torch.Tensor:
+        self.drain()
+        loss = self.trainer.step()
+        if self.trainer.steps % self.publish_interval == 0:
+            self.weights.publish(self.trainer.nn)
+        return loss
+
+    def drain(self) -> None:
+        while True:
+            try:
+                x, published, returns = self.transitions.get_nowait()
+            except queue.Empty:
+                return
+            self.trainer.buffer.push(x)
+            self.received += len(x)
+            self.staleness += (self.weights.published - published) * len(x)
+            self.returns.extend(returns)
+
+    def reset(self) -> None:
+        self.trainer.reset()
+        self.received = 0
+        self.staleness = 0
+        self.returns : list[float] = []
+
+    def stats(self) -> dict:
+        """Staleness is averaged over everything received, returns over the episodes since the last call"""
+        returns, self.returns = self.returns, []
+        return {
+            "received": self.received,
+            "staleness": self.staleness / max(self.received, 1),
+            "published": self.weights.published,
+            "episodes": len(returns),
+            "mean_return": sum(returns) / max(len(returns), 1)
+        }
+
+
+def start_actors(
+    count: int,
+    make_env: Callable[[], Environment],
+    make_network: Callable[[], torch.nn.Module],
+    make_strategy: Callable[[int], Strategy],
+    weights: SharedWeights,
+    transitions: mp.Queue,
+    chunk: int,
+    sync_interval: int,
+    n_step: int = 1,
+    gamma: float = None,
+    make_engine: Callable[[torch.nn.Module], InferenceEngine] = None
+) -> list[mp.Process]:
+    """`make_strategy` gets the actor index, e.g. to give each actor its own epsilon"""
+    actors = []
+    for i in range(count):
+        args = (make_env, make_network, make_strategy(i), weights, transitions, chunk, sync_interval, n_step, gamma, i, make_engine)
+        process = mp.Process(target=actor, args=args, daemon=True)
+        process.start()
+        actors.append(process)
+    return actors
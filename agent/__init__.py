@@ -1 +1,2 @@
 from .agent import Agent
+from .inference import InferenceEngine
@@ -3,6 +3,8 @@ import torch
 from plugin import Plugin
 from base import Base
 from my_types import State, Action
+from .inference import InferenceEngine
+from profiler import profiled
 
 class Agent(Base):
 
@@ -10,20 +12,29 @@ class Agent(Base):
         self,
         network: torch.nn.Module,
         strategy: Strategy,
+        engine: InferenceEngine = None
     ) -> None:
-        
+        """Acts through `engine` when given, call `refresh` after training to update it"""
         self.network = network
         self.strategy = strategy
+        self.engine = engine
     
+    @profiled("agent.select")
     def select(self, state: State) -> Action:
+        if self.engine is not None:
+            return self.engine.select(state, self.strategy).view(-1, 1)
         with torch.no_grad():
             q = self.network(state)
-            return self.strategy.select(q).unsqueeze(0)
+            return self.strategy.select(q).view(-1, 1)
 
     def step(self, state: State) -> Action:
         self.strategy.step()
         return self.select(state)
     
+    def refresh(self) -> None:
+        if self.engine is not None:
+            self.engine.refresh()
+
     def reset(self) -> None:
         self.strategy.reset()
 
@@ -0,0 +1,192 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.quantization as quant
+from torch.nn.utils.fusion import fuse_conv_bn_weights
+import random
+from architecture import Network
+from strategy import Strategy
+from util import autocast
+from my_types import State, Action, Q
+
+
+LAYERS = [("conv1", "bn1"), ("conv2", "bn2"), ("conv3", "bn3")]
+
+
+class FoldedNetwork(nn.Module):
+
+    def __init__(self, network: Network) -> None:
+        """`Network` in eval mode, with each BatchNorm folded into the conv before it"""
+        super().__init__()
+        self.convs = nn.ModuleList()
+        for conv, _ in LAYERS:
+            c : nn.Conv2d = getattr(network, conv)
+            self.convs.append(nn.Conv2d(
+                c.in_channels, c.out_channels, c.kernel_size, c.stride, device=c.weight.device
+            ))
+        h : nn.Linear = network.head
+        self.head = nn.Linear(h.in_features, h.out_features, device=h.weight.device)
+        self.requires_grad_(False)
+        self.eval()
+
+    @torch.no_grad()
+    def load(self, network: Network) -> None:
+        for folded, (conv, bn) in zip(self.convs, LAYERS):
+            c : nn.Conv2d = getattr(network, conv)
+            b : nn.BatchNorm2d = getattr(network, bn)
+            w, bias = fuse_conv_bn_weights(
+                c.weight, c.bias, b.running_mean, b.running_var, b.eps, b.weight, b.bias
+            )
+            folded.weight.copy_(w)
+            folded.bias.copy_(bias)
+        self.head.weight.copy_(network.head.weight)
+        self.head.bias.copy_(network.head.bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        for conv in self.convs:
+            x = F.relu(conv(x))
+        return self.head(x.flatten(1))
+
+
+class QuantizedNetwork(nn.Module):
+
+    def __init__(self, folded: FoldedNetwork) -> None:
+        """Float copy of `folded` with quant stubs and conv + relu pairs, ready for eager static quantization"""
+        super().__init__()
+        self.quant = quant.QuantStub()
+        self.convs = nn.ModuleList(
+            nn.Sequential(nn.Conv2d(c.in_channels, c.out_channels, c.kernel_size, c.stride), nn.ReLU())
+            for c in folded.convs
+        )
+        self.head = nn.Linear(folded.head.in_features, folded.head.out_features)
+        self.dequant = quant.DeQuantStub()
+        self.load_state_dict(folded.state_dict(), strict=False)
+        with torch.no_grad():
+            for mine, theirs in zip(self.convs, folded.convs):
+                mine[0].weight.copy_(theirs.weight)
+                mine[0].bias.copy_(theirs.bias)
+        self.eval()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.quant(x)
+        for conv in self.convs:
+            x = conv(x)
+        x = self.head(x.flatten(1))
+        return self.dequant(x)
+
+
+def quantize(folded: FoldedNetwork, states: torch.Tensor) -> nn.Module:
+    """int8 copy of `folded`, with activation ranges calibrated on `states`"""
+    model = QuantizedNetwork(folded)
+    model.qconfig = quant.QConfig(
+        activation=quant.MinMaxObserver.with_args(reduce_range=True),
+        weight=quant.default_per_channel_weight_observer
+    )
+    quant.fuse_modules(model, [[f"convs.{i}.0", f"convs.{i}.1"] for i in range(len(model.convs))], inplace=True)
+    quant.prepare(model, inplace=True)
+    with torch.no_grad():
+        model(states.contiguous(memory_format=torch.channels_last))
+    return quant.convert(model, inplace=True)
+
+
+class InferenceEngine:
+
+    def __init__(self, network: Network, quantize: bool = False, calibration: int = 64) -> None:
+        """
+        Frozen copy of `network` for acting: BatchNorm folded into the convs, channels_last and `inference_mode`.
+        Rows the strategy is going to explore anyway skip the forward.
+        Doesn't follow training by itself, call `refresh` to pick up new weights.
+
+        With `quantize`, acts with a static int8 copy instead, CPU only.
+        It is rebuilt and recalibrated by every `refresh`, on a reservoir sample of `calibration` states
+        acted on since the previous refresh, so the float copy is used until the first refresh after some acting.
+        Until a new window fills it, the sample keeps states from the window before.
+        Rebuilding costs about one forward over the calibration states.
+        """
+        assert not quantize or network.device.type == "cpu", "Quantized inference runs on CPU"
+        self.source = network
+        self.device = network.device
+        self.network = FoldedNetwork(network).to(memory_format=torch.channels_last)
+        self.quantize = quantize
+        self.quantized : nn.Module = None
+        self.calibration = calibration
+        self.seen : list[torch.Tensor] = []
+        self.offered = 0
+        self.random = random.Random(0)
+        self.refresh()
+
+    def refresh(self) -> None:
+        self.network.load(self.source)
+        if self.quantize and self.seen:
+            self.quantized = quantize(self.network, torch.cat(self.seen))
+        self.offered = 0
+
+    def observe(self, x: torch.Tensor) -> None:
+        """Reservoir sampling, states are only copied when they go into the sample"""
+        for row in x.split(1):
+            self.offered += 1
+            if self.offered <= self.calibration:
+                i = self.offered - 1
+            else:
+                i = self.random.randrange(self.offered)
+                if i >= self.calibration:
+                    continue
+            if i < len(self.seen):
+                self.seen[i] = row.clone()
+            else:
+                self.seen.append(row.clone())
+
+    def __call__(self, state: State) -> Q:
+        with torch.inference_mode(), autocast(self.device, self.source.autocast):
+            x = state.to(self.device, memory_format=torch.channels_last)
+            if self.quantize:
+                self.observe(x)
+            if self.quantized is not None:
+                return self.quantized(x)
+            return self.network(x).float()
+
+    def disagreement(self, states: State = None) -> float:
+        """How often the int8 argmax differs from the float one, on `states` or the calibration states"""
+        assert self.quantized is not None, "Nothing quantized yet"
+        if states is None:
+            states = torch.cat(self.seen)
+        with torch.inference_mode():
+            x = states.to(self.device, memory_format=torch.channels_last)
+            a = self.network(x).argmax(1)
+            b = self.quantized(x).argmax(1)
+            return (a != b).float().mean().item()
+
+    def select(self, state: State, strategy: Strategy) -> Action:
+        with torch.inference_mode():
+            batch_size = state.size(0)
+            explore = strategy.explore(batch_size, self.device)
+            q = torch.zeros(batch_size, self.source.output_size, device=self.device)
+            exploit = explore.logical_not().nonzero().squeeze(1)
+            if len(exploit) == batch_size:
+                q = self(state)
+            elif len(exploit) > 0:
+                q[exploit] = self(state[exploit])
+            return strategy.select(q, explore)
+
+
+if __name__ == "__main__":
+    import time
+    torch.set_num_threads(1)
+    network = Network((1, 3, 84, 84), 4, torch.device("cpu"))
+    float_engine = InferenceEngine(network)
+    int8_engine = InferenceEngine(network, quantize=True)
+    for _ in range(64):
+        int8_engine(torch.rand(1, 3, 84, 84))
+    int8_engine.refresh()
+
+    x = torch.rand(256, 3, 84, 84)
+    print(f"int8 argmax disagrees on {int8_engine.disagreement(x):.1%} of states")
+    assert (float_engine(x) - network.eval()(x)).abs().max() < 1e-4
+
+    for name, engine in [("float", float_engine), ("int8", int8_engine)]:
+        for row in x[:16].split(1):
+            engine(row)
+        start = time.perf_counter()
+        for row in x.split(1):
+            engine(row)
+        print(f"{name}: {(time.perf_counter() - start) / len(x) * 1e6:.0f} us per action")
@@ -1,7 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from util import conv2d_output_size
+from util import conv2d_output_size, autocast
 
 class Network(torch.nn.Module):
 
@@ -9,10 +9,16 @@ class Network(torch.nn.Module):
         self,
         input_size: tuple[int,int,int],
         output_size: int,
-        device: torch.device
+        device: torch.device,
+        autocast: torch.dtype = None
     ):
+        """
+        With `autocast` (e.g. torch.bfloat16), forward runs under autocast in that dtype.
+        Weights and the returned q values stay float32.
+        """
         super(Network, self).__init__()
         self.device = device
+        self.autocast = autocast
         self.input_size = input_size
         self.output_size = output_size
         b, c, w, h = input_size
@@ -40,19 +46,21 @@ class Network(torch.nn.Module):
     
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = x.to(self.device)
-        x = F.relu(self.bn1(self.conv1(x)))
-        x = F.relu(self.bn2(self.conv2(x)))
-        x = F.relu(self.bn3(self.conv3(x)))
-        x = x.view(x.size(0), -1)
-        return self.head(x)
+        with autocast(self.device, self.autocast):
+            x = F.relu(self.bn1(self.conv1(x)))
+            x = F.relu(self.bn2(self.conv2(x)))
+            x = F.relu(self.bn3(self.conv3(x)))
+            x = x.view(x.size(0), -1)
+            x = self.head(x)
+        return x.float()
     
     def copy(self) -> "Network":
-        x = Network(self.input_size, self.output_size, self.device)
+        x = Network(self.input_size, self.output_size, self.device, self.autocast)
         x.load_state_dict(self.state_dict())
         return x
         
 if __name__ == "__main__":
-    net = Network((2, 100, 100), 2)
+    net = Network((1, 2, 100, 100), 2, torch.device("cpu"))
     x = torch.rand((1, 2, 100, 100))
     y = net(x)
     assert y.size() == torch.Size([1, 2])
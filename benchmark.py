@@ -0,0 +1,393 @@
+from agent import Agent, InferenceEngine
+from strategy import EpsilonGreedy
+from environment import SyntheticEnvironment
+from trainer import OffPolicyTrainer
+from replay_buffer import ReplayBuffer, FrameReplayBuffer, TransitionBatch
+from prefetcher import Prefetcher
+from architecture import Network
+from recorder import Recorder
+from profiler import PROFILER
+from typing import Callable
+import preprocessing as prep
+import torch.multiprocessing as mp
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+import torch
+
+"""
+Benchmark suite. Every benchmark runs in a fresh process, so peak memory is its own,
+and everything ends up in one json file to compare between versions:
+
+    python benchmark.py --out before.json
+"""
+
+
+def latency(ns: list[int]) -> dict:
+    """Percentiles of per-call times, in microseconds"""
+    x = torch.tensor(ns, dtype=torch.float64) / 1e3
+    q = torch.quantile(x, torch.tensor([0.5, 0.9, 0.99], dtype=torch.float64)).tolist()
+    return {"mean_us": x.mean().item(), "p50_us": q[0], "p90_us": q[1], "p99_us": q[2]}
+
+
+def timed(fn: Callable, count: int, warmup: int = 10) -> tuple[dict, float]:
+    """Latency of `fn` over `count` calls, and calls per second"""
+    for _ in range(warmup):
+        fn()
+    ns = []
+    start = time.perf_counter_ns()
+    for _ in range(count):
+        t = time.perf_counter_ns()
+        fn()
+        ns.append(time.perf_counter_ns() - t)
+    total = time.perf_counter_ns() - start
+    return latency(ns), count / total * 1e9
+
+
+def peak_memory_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def memory_mb() -> float:
+    """Current resident memory, unlike `peak_memory_mb` it goes down again when things are freed"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def storage_mb(buffer: ReplayBuffer) -> float:
+    """What the buffer's own storage takes, without the rest of the process"""
+    return sum(x.nbytes for x in buffer.storage.fields.values()) / 2 ** 20
+
+
+def make_env(img_size: int, frames: int, episode_length: int = 1000) -> SyntheticEnvironment:
+    """Same preprocessing as `run.make_env`"""
+    return SyntheticEnvironment(
+        torch.device("cpu"),
+        [
+            prep.FusedFrame((img_size, img_size)),
+            prep.AddBatchDim(),
+            prep.MultiFrame(frames)
+        ],
+        episode_length=episode_length
+    )
+
+
+def transitions(env: SyntheticEnvironment, count: int) -> list[TransitionBatch]:
+    """`count` consecutive transitions of `env`, acting in a fixed cycle"""
+    out = []
+    state = env.reset()
+    for i in range(count):
+        action = torch.tensor([[i % env.action_count]])
+        next_state, r, done = env.step(action)
+        out.append(TransitionBatch(state, action, r, next_state, done))
+        state = env.reset() if done.item() else next_state
+    return out
+
+
+def bench_env(args) -> dict:
+    env = make_env(args.img_size, args.frames)
+    env.reset()
+    actions = [torch.tensor([[i % env.action_count]]) for i in range(args.steps)]
+    i = iter(actions * 2)
+    def step():
+        _, _, done = env.step(next(i))
+        if done.item():
+            env.reset()
+    lat, rate = timed(step, args.steps)
+    return {"env_steps_per_s": rate, "step": lat}
+
+
+def bench_preprocessing(args) -> dict:
+    env = SyntheticEnvironment(torch.device("cpu"))
+    image = env.images[0]
+    fused = prep.FusedFrame((args.img_size, args.img_size))
+    add_batch = prep.AddBatchDim()
+    multi = prep.MultiFrame(args.frames)
+    frame = add_batch(fused(image))
+    chain = [fused, add_batch, multi]
+
+    def run_chain():
+        x = image
+        for p in chain:
+            x = p(x)
+
+    out = {}
+    for name, fn in [("fused_frame", lambda: fused(image)), ("multi_frame", lambda: multi(frame)), ("chain", run_chain)]:
+        lat, rate = timed(fn, args.steps)
+        out[name] = {"calls_per_s": rate, **lat}
+    return out
+
+
+def bench_buffer(args) -> dict:
+    """
+    Memory is reported per buffer size, as the storage's own bytes and as the growth
+    of resident memory from creating the buffer to filling it
+    """
+    env = make_env(args.img_size, args.frames)
+    # uint8, like the buffers store them, so the pushed rows are the same at a quarter of the memory
+    data = [
+        TransitionBatch(
+            x.s_now.mul(255).round_().to(torch.uint8), x.a, x.r,
+            x.s_next.mul(255).round_().to(torch.uint8), x.done
+        )
+        for x in transitions(env, 2000)
+    ]
+    row_bytes = {
+        "frame": args.img_size ** 2,
+        "transition": 2 * args.frames * args.img_size ** 2,
+    }
+    out = {}
+    for kind in ["frame", "transition"]:
+        for size in args.buffer_sizes:
+            name = f"{kind}_{size}"
+            if row_bytes[kind] * size > args.max_buffer_bytes:
+                out[name] = {"skipped": f"over {args.max_buffer_bytes} bytes"}
+                continue
+            before = memory_mb()
+            if kind == "frame":
+                buffer = FrameReplayBuffer(size, torch.device("cpu"), args.frames, obs_dtype=torch.uint8)
+            else:
+                buffer = ReplayBuffer(size, torch.device("cpu"), obs_dtype=torch.uint8)
+
+            # Fill the buffer to capacity, timing the pushes along the way
+            ns = []
+            for i in range(max(size, len(data))):
+                x = data[i % len(data)]
+                t = time.perf_counter_ns()
+                buffer.push(x)
+                ns.append(time.perf_counter_ns() - t)
+                if x.done.item():
+                    buffer.ep_reset()
+            push = latency(ns)
+            sample, rate = timed(lambda: buffer.sample(args.batch_size), args.steps)
+            out[name] = {
+                "push_rows_per_s": 1e6 / push["mean_us"],
+                "push": push,
+                "sample_batches_per_s": rate,
+                "sample": sample,
+                "storage_mb": storage_mb(buffer),
+                "memory_delta_mb": memory_mb() - before
+            }
+            del buffer, ns
+    return out
+
+
+def bench_network(args) -> dict:
+    torch.manual_seed(0)
+    input_size = torch.Size([1, args.frames, args.img_size, args.img_size])
+    network = Network(input_size, 4, torch.device("cpu"))
+    out = {}
+    for batch in [1, args.batch_size]:
+        x = torch.rand(batch, *input_size[1:])
+        with torch.no_grad():
+            lat, rate = timed(lambda: network(x), args.steps)
+        out[f"forward_{batch}"] = {"calls_per_s": rate, **lat}
+
+        def backward():
+            network.zero_grad()
+            network(x).sum().backward()
+        lat, rate = timed(backward, max(args.steps // 4, 1))
+        out[f"forward_backward_{batch}"] = {"calls_per_s": rate, **lat}
+    return out
+
+
+def bench_agent(args) -> dict:
+    torch.manual_seed(0)
+    input_size = torch.Size([1, args.frames, args.img_size, args.img_size])
+    network = Network(input_size, 4, torch.device("cpu"))
+    state = torch.rand(input_size)
+    out = {}
+    for epsilon in [0.0, 0.5]:
+        strategy = EpsilonGreedy(epsilon, epsilon, 1)
+        strategy.reset()
+        agents = {
+            "network": Agent(network, strategy),
+            "engine": Agent(network, strategy, InferenceEngine(network)),
+            "int8": Agent(network, strategy, InferenceEngine(network, quantize=True)),
+        }
+        agents["int8"].engine(state)
+        agents["int8"].refresh()
+        for name, agent in agents.items():
+            lat, rate = timed(lambda: agent.select(state), args.steps)
+            out[f"{name}_epsilon_{epsilon}"] = {"actions_per_s": rate, **lat}
+    return out
+
+
+def train_step(compile: bool, autocast: torch.dtype, steps: int, warmup: int, batch_size: int, img_size: int, frames: int) -> float:
+    """Gradient steps per second of `OffPolicyTrainer` on random data"""
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    input_size = torch.Size([1, frames, img_size, img_size])
+    buffer = ReplayBuffer(1000, device)
+    for _ in range(1000):
+        buffer.push(TransitionBatch(
+            torch.rand(input_size),
+            torch.randint(0, 4, (1, 1)),
+            torch.rand(1, 1),
+            torch.rand(input_size),
+            torch.rand(1, 1) < 0.01
+        ))
+
+    network = Network(input_size, 4, device, autocast)
+    trainer = OffPolicyTrainer(
+        100,
+        buffer,
+        network,
+        torch.optim.Adam(network.parameters()),
+        batch_size,
+        0.99,
+        1,
+        compile=compile,
+        autocast=autocast
+    )
+    trainer.reset()
+
+    for _ in range(warmup):
+        trainer.step()
+    updates = trainer.updates
+    start = time.perf_counter()
+    for _ in range(steps):
+        trainer.step()
+    return (trainer.updates - updates) / (time.perf_counter() - start)
+
+
+def bench_train(args) -> dict:
+    modes = {
+        "eager": (False, None),
+        "compiled": (True, None),
+        "bf16": (False, torch.bfloat16),
+        "compiled_bf16": (True, torch.bfloat16),
+    }
+    steps = max(args.steps // 4, 1)
+    return {
+        name: {"grad_steps_per_s": train_step(compile, autocast, steps, 10, args.batch_size, args.img_size, args.frames)}
+        for name, (compile, autocast) in modes.items()
+    }
+
+
+def bench_loop(args, profile: bool = False) -> dict:
+    """The loop of `run.py`, on `SyntheticEnvironment` and without plotting"""
+    torch.manual_seed(0)
+    device = torch.device("cpu")
+    steps_per_update = 4
+    env = make_env(args.img_size, args.frames, episode_length=500)
+    input_size, output_size = env.size()
+    buffer = FrameReplayBuffer(10000, device, args.frames, obs_dtype=torch.uint8)
+    network = Network(input_size, output_size, device)
+    strategy = EpsilonGreedy(0.9, 0.05, 10000)
+    agent = Agent(network, strategy, InferenceEngine(network))
+    trainer = OffPolicyTrainer(
+        5 * steps_per_update,
+        Prefetcher(buffer, args.batch_size, 2),
+        network,
+        torch.optim.Adam(network.parameters()),
+        args.batch_size,
+        0.99,
+        steps_per_update=steps_per_update
+    )
+    recorder = Recorder(100, 50)
+    trainer.listen(agent.refresh)
+    agent.reset()
+    trainer.reset()
+    recorder.on_game_reset()
+
+    PROFILER.enabled = profile
+    ns = []
+    state = env.reset()
+    buffer.ep_reset()
+    start = time.perf_counter_ns()
+    for steps in range(1, args.steps + 1):
+        t = time.perf_counter_ns()
+        action = agent.step(state)
+        next_state, r, done = env.step(action)
+        with PROFILER.section("buffer.push"):
+            buffer.push(TransitionBatch(state, action, r, next_state, done))
+        state = next_state
+        loss = trainer.step()
+        recorder.step(r, loss)
+        if done.item():
+            state = env.reset()
+            buffer.ep_reset()
+        ns.append(time.perf_counter_ns() - t)
+    total = time.perf_counter_ns() - start
+    trainer.buffer.close()
+    PROFILER.disable()
+    result = {
+        "env_steps_per_s": args.steps / total * 1e9,
+        "grad_steps_per_s": trainer.updates / total * 1e9,
+        "grad_steps": trainer.updates,
+        "step": latency(ns)
+    }
+    if profile:
+        result["profile"] = PROFILER.summary()
+    return result
+
+
+def bench_profile(args) -> dict:
+    """`bench_loop` with the profiler on, its overhead is the difference between the two"""
+    return bench_loop(args, profile=True)
+
+
+BENCHMARKS = {
+    "env": bench_env,
+    "preprocessing": bench_preprocessing,
+    "buffer": bench_buffer,
+    "network": bench_network,
+    "agent": bench_agent,
+    "train": bench_train,
+    "loop": bench_loop,
+    "profile": bench_profile,
+}
+
+
+def isolated(name: str, args) -> dict:
+    result = BENCHMARKS[name](args)
+    result["peak_memory_mb"] = peak_memory_mb()
+    return result
+
+
+def meta() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "threads": torch.get_num_threads(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--only", type=lambda x: x.split(","), default=list(BENCHMARKS))
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--steps", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--img-size", type=int, default=84)
+    parser.add_argument("--frames", type=int, default=3)
+    parser.add_argument("--buffer-sizes", type=lambda x: [int(v) for v in x.split(",")], default=[1000, 10000, 100000])
+    parser.add_argument("--max-buffer-bytes", type=int, default=1 << 30)
+    args = parser.parse_args()
+
+    results = {}
+    context = mp.get_context("spawn")
+    for name in args.only:
+        start = time.perf_counter()
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(isolated, (name, args))
+        print(f"{name}: {time.perf_counter() - start:.1f}s")
+        print(json.dumps(results[name], indent=1))
+
+    with open(args.out, "w") as f:
+        json.dump({"meta": meta(), "args": vars(args), "results": results}, f, indent=1)
@@ -0,0 +1,224 @@
+from typing import Any
+from contextlib import ExitStack
+import array
+import json
+import os
+import shutil
+import threading
+import traceback
+import warnings
+import torch
+
+CHUNK = 64 << 20
+
+
+def pack(x: Any, tensors: list) -> Any:
+    """
+    Turns a nested state dict into something json can hold.
+    Tensors and lists of byte blobs are replaced by their index in `tensors`, and written separately.
+    """
+    if isinstance(x, torch.Tensor):
+        tensors.append(x)
+        return {"__tensor__": len(tensors) - 1, "dtype": str(x.dtype), "size": list(x.size())}
+    if isinstance(x, list) and x and all(b is None or isinstance(b, bytes) for b in x):
+        tensors.append(x)
+        return {"__blobs__": len(tensors) - 1}
+    if isinstance(x, dict):
+        return {"__dict__": [[pack(k, tensors), pack(v, tensors)] for k, v in x.items()]}
+    if isinstance(x, tuple):
+        return {"__tuple__": [pack(v, tensors) for v in x]}
+    if isinstance(x, list):
+        return [pack(v, tensors) for v in x]
+    if isinstance(x, torch.dtype):
+        return {"__dtype__": str(x)}
+    return x
+
+
+def unpack(x: Any, path: str) -> Any:
+    if isinstance(x, list):
+        return [unpack(v, path) for v in x]
+    if not isinstance(x, dict):
+        return x
+    if "__tensor__" in x:
+        return load_tensor(os.path.join(path, f"{x['__tensor__']}.bin"), x["dtype"], x["size"])
+    if "__blobs__" in x:
+        return load_blobs(os.path.join(path, f"{x['__blobs__']}.bin"))
+    if "__dict__" in x:
+        return {unpack(k, path): unpack(v, path) for k, v in x["__dict__"]}
+    if "__tuple__" in x:
+        return tuple(unpack(v, path) for v in x["__tuple__"])
+    if "__dtype__" in x:
+        return getattr(torch, x["__dtype__"].split(".")[-1])
+    return x
+
+
+def prepare(x: torch.Tensor) -> torch.Tensor:
+    """CPU, contiguous and detached, so the writer only has to look at the bytes"""
+    return x.detach().cpu().contiguous()
+
+
+def write_tensor(path: str, x: torch.Tensor) -> None:
+    """Raw bytes of `x`, straight from its memory, `CHUNK` bytes per write"""
+    data = memoryview(x.reshape(-1).view(torch.uint8).numpy()) if x.numel() else memoryview(b"")
+    with open(path, "wb") as f:
+        for start in range(0, len(data), CHUNK):
+            f.write(data[start:start + CHUNK])
+
+
+def load_tensor(path: str, dtype: str, size: list[int]) -> torch.Tensor:
+    """Mapped copy-on-write, pages are read when touched and writes never reach the file"""
+    dtype = getattr(torch, dtype.split(".")[-1])
+    numel = torch.Size(size).numel()
+    if numel == 0:
+        return torch.empty(size, dtype=dtype)
+    return torch.from_file(path, shared=False, size=numel, dtype=dtype).view(size)
+
+
+def write_blobs(path: str, blobs: list[bytes]) -> None:
+    """Lengths first, -1 for empty slots, then the blobs back to back"""
+    lengths = array.array("q", [-1 if b is None else len(b) for b in blobs])
+    with open(path, "wb") as f:
+        f.write(len(blobs).to_bytes(8, "little"))
+        f.write(lengths.tobytes())
+        for b in blobs:
+            if b is not None:
+                f.write(b)
+
+
+def load_blobs(path: str) -> list[bytes]:
+    with open(path, "rb") as f:
+        n = int.from_bytes(f.read(8), "little")
+        lengths = array.array("q", f.read(8 * n))
+        return [None if length < 0 else f.read(length) for length in lengths]
+
+
+def write(path: str, meta: Any, tensors: list) -> None:
+    """Writes to `path`.tmp and renames, so `path` is either complete or missing"""
+    tmp = path + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for i, x in enumerate(tensors):
+        file = os.path.join(tmp, f"{i}.bin")
+        if isinstance(x, torch.Tensor):
+            write_tensor(file, x)
+        else:
+            write_blobs(file, x)
+    with open(os.path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    os.rename(tmp, path)
+
+
+class Checkpointer:
+
+    def __init__(self, path: str, keep: int = 2, fork: bool = None) -> None:
+        """
+        Saves checkpoints to `path`/step-N, keeping the last `keep`.
+        Training only pauses to collect state dicts and fork, the child process writes
+        the copy-on-write image of memory to disk while training goes on.
+        The child only reads tensor memory through numpy, it never runs a torch kernel.
+
+        A child forked while another thread holds a lock can deadlock, so `save` pauses
+        what it is given to pause (e.g. a `Prefetcher`) and only forks when no other Python thread is left.
+        Otherwise, or with `fork=False`, tensors are cloned and written on a thread instead.
+
+        Each tensor is one raw file, loading maps them instead of reading,
+        so resuming doesn't wait for the replay buffer to come off the disk.
+        """
+        self.path = path
+        self.keep = keep
+        self.fork = hasattr(os, "fork") and fork is not False
+        self.pid = None
+        self.thread = None
+        os.makedirs(path, exist_ok=True)
+
+    def save(self, step: int, objects: dict[str, Any], pause: list[Any] = ()) -> None:
+        """
+        `objects` are anything with `state_dict`, or plain values.
+        Their `lock`, if they have one, is held while their state is taken.
+        `pause` are things running threads, with `pause` and `resume`, stopped until the state is taken.
+        """
+        self.wait()
+        for x in pause:
+            x.pause()
+        try:
+            self.snapshot(step, objects)
+        finally:
+            for x in pause:
+                x.resume()
+
+    def snapshot(self, step: int, objects: dict[str, Any]) -> None:
+        with ExitStack() as stack:
+            state = {}
+            for key, x in objects.items():
+                if hasattr(x, "lock"):
+                    stack.enter_context(x.lock)
+                state[key] = x.state_dict() if hasattr(x, "state_dict") else x
+            tensors = []
+            meta = pack(state, tensors)
+            tensors = [prepare(x) if isinstance(x, torch.Tensor) else x for x in tensors]
+            target = os.path.join(self.path, f"step-{step}")
+
+            fork = self.fork
+            others = [t.name for t in threading.enumerate() if t is not threading.current_thread()]
+            if fork and others:
+                warnings.warn(f"Threads {others} are running, checkpointing on a thread instead of forking")
+                fork = False
+            if fork:
+                self.pid = os.fork()
+                if self.pid == 0:
+                    code = 0
+                    try:
+                        write(target, meta, tensors)
+                        self.finish(step)
+                    except BaseException:
+                        traceback.print_exc()
+                        code = 1
+                    finally:
+                        os._exit(code)
+                return
+
+            tensors = [x.clone() if isinstance(x, torch.Tensor) else list(x) for x in tensors]
+        self.thread = threading.Thread(target=self.background, args=(target, meta, tensors, step), daemon=True)
+        self.thread.start()
+
+    def background(self, target: str, meta: Any, tensors: list, step: int) -> None:
+        write(target, meta, tensors)
+        self.finish(step)
+
+    def finish(self, step: int) -> None:
+        """Points `latest` at the new checkpoint and removes the old ones"""
+        tmp = os.path.join(self.path, "latest.tmp")
+        with open(tmp, "w") as f:
+            f.write(f"step-{step}")
+        os.replace(tmp, os.path.join(self.path, "latest"))
+
+        steps = sorted(
+            int(name[5:]) for name in os.listdir(self.path)
+            if name.startswith("step-") and name[5:].isdigit()
+        )
+        for old in steps[:-self.keep]:
+            shutil.rmtree(os.path.join(self.path, f"step-{old}"), ignore_errors=True)
+
+    def wait(self) -> None:
+        if self.pid is not None:
+            _, status = os.waitpid(self.pid, 0)
+            if status != 0:
+                warnings.warn(f"Checkpoint writer exited with status {status}")
+            self.pid = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def latest(self) -> str:
+        """Directory of the newest complete checkpoint, or None"""
+        pointer = os.path.join(self.path, "latest")
+        if not os.path.exists(pointer):
+            return None
+        with open(pointer) as f:
+            return os.path.join(self.path, f.read().strip())
+
+    def load(self, path: str = None) -> dict[str, Any]:
+        """State dicts by the names they were saved with, from `path` or the latest checkpoint"""
+        path = path or self.latest()
+        with open(os.path.join(path, "meta.json")) as f:
+            return unpack(json.load(f), path)
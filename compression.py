@@ -0,0 +1,44 @@
+from abc import ABC, abstractmethod
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Codec(ABC):
+    """Compresses a single row of a field"""
+
+    @abstractmethod
+    def encode(self, data: memoryview) -> bytes:
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCodec(Codec):
+
+    def __init__(self, level: int = 1) -> None:
+        self.level = level
+
+    def encode(self, data: memoryview) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decode(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class LZ4Codec(Codec):
+
+    def __init__(self) -> None:
+        if lz4 is None:
+            raise ImportError("LZ4Codec requires the `lz4` package")
+
+    def encode(self, data: memoryview) -> bytes:
+        return lz4.frame.compress(data)
+
+    def decode(self, data: bytes) -> bytes:
+        return lz4.frame.decompress(data)
@@ -1,10 +1,11 @@
 from abc import ABC, abstractmethod
 import torch
+import torch.multiprocessing as mp
 from base import Base
 from typing import overload, Callable
 from preprocessing import Preprocessing
 from my_types import State, Action, Reward, Done
-import gym
+from profiler import PROFILER, profiled
 
 """
 My wrapper environment
@@ -31,6 +32,17 @@ class Environment(Base):
     def reset(self) -> None:
         for prep in self.preprocessing:
             prep.ep_reset()
+
+    def preprocess(self, image) -> State:
+        """Runs `image` through `preprocessing`, timing each stage while profiling"""
+        if not PROFILER.enabled:
+            for prep in self.preprocessing:
+                image = prep(image)
+            return image
+        for prep in self.preprocessing:
+            with PROFILER.section(f"prep.{type(prep).__name__}"):
+                image = prep(image)
+        return image
         
 
 class ALE(Environment):
@@ -43,14 +55,16 @@ class ALE(Environment):
         **kwargs
     ) -> None:
         super().__init__(*args, **kwargs)
+        import gym
         self.env = gym.make(game_name, frameskip=frameskip, **kwargs)
     
+    @profiled("env.step")
     def step(self, action: Action) -> tuple[State, Reward, Done]:
         # Types are : np.array, float, bool
-        next_image, reward, done, _ = self.env.step(action.item())
+        with PROFILER.section("ale.step"):
+            next_image, reward, done, _ = self.env.step(action.item())
 
-        for preprocessing in self.preprocessing:
-            next_image = preprocessing(next_image)
+        next_image = self.preprocess(next_image)
         
         if reward > 1:
             reward = 1
@@ -66,10 +80,7 @@ class ALE(Environment):
         self.env.reset()
 
         next_image, reward, done, _ = self.env.step(self.env.action_space.sample())
-        
-        for preprocessing in self.preprocessing:
-            next_image = preprocessing(next_image)
-        return next_image
+        return self.preprocess(next_image)
         
 
     def size(self) -> tuple[torch.Size, int]:
@@ -80,6 +91,136 @@ class ALE(Environment):
 
         return size, self.env.action_space.n
 
+class SyntheticEnvironment(Environment):
+
+    def __init__(
+        self,
+        device: torch.device,
+        preprocessing: list[Preprocessing] = None,
+        shape: tuple[int, int, int] = (210, 160, 3),
+        action_count: int = 4,
+        episode_length: int = 1000,
+        frames: int = 16,
+        seed: int = 0
+    ) -> None:
+        """
+        Deterministic stand-in for `ALE`, without gym or ROMs. Meant for benchmarks.
+        Steps through a bank of `frames` random uint8 images shaped like Atari frames,
+        the next one picked by the step count and the action.
+        Reward is 1 when the action equals step % `action_count`, episodes end after `episode_length` steps.
+        """
+        super().__init__(device, preprocessing)
+        self.shape = shape
+        self.action_count = action_count
+        self.episode_length = episode_length
+        generator = torch.Generator().manual_seed(seed)
+        self.images = torch.randint(0, 256, (frames, *shape), dtype=torch.uint8, generator=generator).numpy()
+        self.t = 0
+
+    @profiled("env.step")
+    def step(self, action: Action) -> tuple[State, Reward, Done]:
+        a = int(action.item())
+        self.t += 1
+        next_image = self.preprocess(self.images[(self.t * 7 + a) % len(self.images)])
+
+        reward = 1.0 if a == self.t % self.action_count else 0.0
+        reward_tensor = torch.tensor([[reward]], device=self.device)
+        done_tensor = torch.tensor([[self.t >= self.episode_length]], device=self.device)
+        return next_image, reward_tensor, done_tensor
+
+    def reset(self) -> State:
+        super().reset()
+        self.t = 0
+        return self.preprocess(self.images[0])
+
+    def size(self) -> tuple[torch.Size, int]:
+        size = torch.Size(self.shape)
+        for prep in self.preprocessing:
+            size = prep.size(size)
+        return size, self.action_count
+
+def vector_worker(make_env: Callable[[], Environment], remote, index: int) -> None:
+    """Runs one environment of a `VectorEnvironment`, writes its states into the shared buffer"""
+    torch.set_num_threads(1)
+    env = make_env()
+    remote.send(env.size())
+    states = remote.recv()
+
+    while True:
+        cmd, action = remote.recv()
+        if cmd == "step":
+            state, reward, done = env.step(torch.tensor([action]))
+            done = bool(done.item())
+            if done:
+                state = env.reset()
+            states[index].copy_(state[0])
+            remote.send((reward.item(), done))
+        elif cmd == "reset":
+            states[index].copy_(env.reset()[0])
+            remote.send(None)
+        elif cmd == "close":
+            remote.close()
+            return
+
+
+class VectorEnvironment(Environment):
+
+    def __init__(self, make_envs: list[Callable[[], Environment]], device: torch.device) -> None:
+        """
+        Steps one environment per subprocess, all at once.
+        Each worker builds its environment with its preprocessing from `make_envs`,
+        and writes states into a shared memory buffer, so only actions, rewards and dones are sent.
+        States, rewards and dones come back batched, one row per environment.
+
+        Environments reset themselves when done, so the state returned for
+        a done row is already the first state of the next episode.
+        That's fine for targets, since `done` masks out `s_next`.
+        """
+        super().__init__(device)
+        self.n = len(make_envs)
+        self.remotes = []
+        self.workers = []
+        for i, make_env in enumerate(make_envs):
+            remote, worker_remote = mp.Pipe()
+            worker = mp.Process(target=vector_worker, args=(make_env, worker_remote, i), daemon=True)
+            worker.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.workers.append(worker)
+
+        self.state_size, self.action_count = self.remotes[0].recv()
+        for remote in self.remotes[1:]:
+            remote.recv()
+
+        self.states = torch.zeros((self.n, *self.state_size[1:])).share_memory_()
+        for remote in self.remotes:
+            remote.send(self.states)
+
+    def step(self, action: Action) -> tuple[State, Reward, Done]:
+        for remote, a in zip(self.remotes, action.flatten().tolist()):
+            remote.send(("step", a))
+        rewards, dones = zip(*[remote.recv() for remote in self.remotes])
+
+        reward_tensor = torch.tensor(rewards, device=self.device).view(-1, 1)
+        done_tensor = torch.tensor(dones, device=self.device).view(-1, 1)
+        return self.states.to(self.device, copy=True), reward_tensor, done_tensor
+
+    def reset(self) -> State:
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.states.to(self.device, copy=True)
+
+    def size(self) -> tuple[torch.Size, int]:
+        return torch.Size([self.n, *self.state_size[1:]]), self.action_count
+
+    def close(self) -> None:
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for worker in self.workers:
+            worker.join()
+
 if __name__ == "__main__":
     import torch
     ale = ALE("ALE/Breakout-v5", [])
@@ -0,0 +1,140 @@
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+from trainer import OffPolicyTrainer
+from replay_buffer import ReplayBuffer
+from architecture import Network
+
+
+def init(rank: int = None, world_size: int = None, backend: str = "gloo") -> None:
+    """
+    Joins the process group. Rank, world size and the master address are
+    read from the environment (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT) unless given,
+    which is what torchrun sets on every node.
+    """
+    os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+    os.environ.setdefault("MASTER_PORT", "29500")
+    if rank is None:
+        rank = int(os.environ["RANK"])
+    if world_size is None:
+        world_size = int(os.environ["WORLD_SIZE"])
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+
+class DataParallelTrainer(OffPolicyTrainer):
+
+    def __init__(
+        self,
+        swap_interval: int,
+        replay_buffer: ReplayBuffer,
+        network: Network,
+        optimizer: torch.optim.Optimizer,
+        batch_size: int,
+        gamma: float,
+        steps_per_update: int,
+        tau: float = None,
+        compile: bool = False,
+        autocast: torch.dtype = None
+    ):
+        """
+        Data-parallel `OffPolicyTrainer` over an initialized process group.
+        Every rank samples `batch_size // world_size` rows from its own buffer,
+        gradients are averaged with one all-reduce before clamping and `optim.step`.
+
+        Ranks start from rank 0's weights and take the same steps, so they stay identical.
+        BatchNorm statistics are averaged every `swap_interval` steps, so targets match as well.
+        """
+        self.world_size = dist.get_world_size()
+        assert batch_size % self.world_size == 0, f"Batch size {batch_size} doesn't split over {self.world_size} ranks"
+        super().__init__(
+            swap_interval,
+            replay_buffer,
+            network,
+            optimizer,
+            batch_size // self.world_size,
+            gamma,
+            steps_per_update,
+            tau,
+            compile,
+            autocast
+        )
+        for t in network.state_dict().values():
+            dist.broadcast(t, 0)
+        # The target was copied from this rank's own initialization
+        self.target_network.sync()
+
+    def step(self) -> torch.Tensor:
+        if self.steps % self.swap_interval == 0:
+            self.sync_buffers()
+        return super().step()
+
+    def is_full(self) -> bool:
+        """Every rank has to train, or none. Otherwise the all-reduce waits forever"""
+        full = torch.tensor([int(super().is_full())])
+        dist.all_reduce(full, op=dist.ReduceOp.MIN)
+        return bool(full.item())
+
+    def reduce_gradients(self) -> None:
+        grads = [p.grad for p in self.nn.parameters() if p.grad is not None]
+        flat = _flatten_dense_tensors(grads)
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        for grad, reduced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+            grad.copy_(reduced)
+
+    def sync_buffers(self) -> None:
+        buffers = [b for b in self.nn.buffers() if b.is_floating_point()]
+        if not buffers:
+            return
+        flat = _flatten_dense_tensors(buffers)
+        dist.all_reduce(flat)
+        flat /= self.world_size
+        for buffer, reduced in zip(buffers, _unflatten_dense_tensors(flat, buffers)):
+            buffer.copy_(reduced)
+
+
+
+def check_ranks(rank: int, world_size: int, port: str, tau: float = None) -> None:
+    """
+    Self-test, trains on random data and checks online and target parameters match on every rank.
+    BatchNorm statistics are left out, they only match right after `sync_buffers`.
+    """
+    from replay_buffer import TransitionBatch
+    os.environ["MASTER_PORT"] = port
+    init(rank, world_size)
+    torch.manual_seed(rank)
+    cpu = torch.device("cpu")
+    network = Network(torch.Size([1, 3, 40, 40]), 4, cpu)
+    buffer = ReplayBuffer(100, cpu)
+    trainer = DataParallelTrainer(7, buffer, network, torch.optim.Adam(network.parameters()), 16, 0.9, 1, tau=tau)
+    trainer.reset()
+    for i in range(40):
+        # Ranks fill at different rates, none trains until all can
+        if i < 20 + 10 * rank:
+            buffer.push(TransitionBatch(
+                torch.rand(1, 3, 40, 40),
+                torch.randint(0, 4, (1, 1)),
+                torch.rand(1, 1),
+                torch.rand(1, 3, 40, 40),
+                torch.tensor([[False]])
+            ))
+        trainer.step()
+
+    for name, module in [("online", network), ("target", trainer.target_network.network)]:
+        x = torch.cat([p.detach().flatten() for p in module.parameters()])
+        gathered = [torch.zeros_like(x) for _ in range(world_size)]
+        dist.all_gather(gathered, x)
+        difference = max((g - gathered[0]).abs().max().item() for g in gathered)
+        if rank == 0:
+            print(f"tau={tau}, {name} max difference across ranks: {difference}")
+        assert difference == 0, f"{name} weights differ across ranks"
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    import torch.multiprocessing as mp
+
+    port = int(os.environ.get("MASTER_PORT", "29511"))
+    for i, tau in enumerate([None, 0.01]):
+        mp.spawn(check_ranks, args=(2, str(port + i), tau), nprocs=2)
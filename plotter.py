@@ -1,8 +1,58 @@
 import matplotlib.pyplot as plt
+import torch.multiprocessing as mp
+
+
+class Series:
+
+    def __init__(self, points: int) -> None:
+        """
+        Min/max downsampled series of at most `points` buckets.
+        Buckets double in width and merge in pairs when they run out, so appending is O(1) amortized
+        and the envelope of the data survives at any length.
+        """
+        self.points = points + points % 2
+        self.width = 1
+        self.lows : list[float] = []
+        self.highs : list[float] = []
+        self.filled = 0
+
+    def append(self, value: float) -> None:
+        if self.filled == 0:
+            if len(self.lows) == self.points:
+                self.merge()
+            self.lows.append(value)
+            self.highs.append(value)
+        else:
+            self.lows[-1] = min(self.lows[-1], value)
+            self.highs[-1] = max(self.highs[-1], value)
+        self.filled = (self.filled + 1) % self.width
+
+    def extend(self, values: list[float]) -> None:
+        for value in values:
+            self.append(value)
+
+    def merge(self) -> None:
+        self.lows = [min(self.lows[i:i + 2]) for i in range(0, len(self.lows), 2)]
+        self.highs = [max(self.highs[i:i + 2]) for i in range(0, len(self.highs), 2)]
+        self.width *= 2
+
+    def xy(self) -> tuple[list[float], list[float]]:
+        """Each bucket becomes a vertical segment from its min to its max"""
+        x, y = [], []
+        for i, (low, high) in enumerate(zip(self.lows, self.highs)):
+            x += [i * self.width, i * self.width]
+            y += [low, high]
+        return x, y
+
 
 class Plotter:
 
-    def __init__(self):
+    def __init__(self, points: int = None):
+        """
+        `plot` redraws everything it is given.
+        With `points`, use `extend` with only the new values instead,
+        series are downsampled to `points` buckets and lines are updated in place.
+        """
         fig, ax = plt.subplots(3,  figsize=(12, 10))
         self.figure = fig
         self.rpe_axes = ax[0]
@@ -10,20 +60,35 @@ class Plotter:
         self.dur_axes = ax[2]
         self.rpe_axes.set_xlabel("Episodes")
         self.rpe_axes.set_ylabel("Rewards")
-        
+
         self.loss_axes.set_xlabel("Steps")
         self.loss_axes.set_ylabel("Loss")
 
         self.dur_axes.set_xlabel("Episode")
         self.dur_axes.set_ylabel("Duration")
-        
+
+        if points is not None:
+            self.series = {key: Series(points) for key in ["rewards", "means", "losses", "duration"]}
+            self.lines = {
+                "rewards": self.rpe_axes.plot([], [], color="black", linewidth=1)[0],
+                "means": self.rpe_axes.plot([], [], color="red", linestyle="--", linewidth=1.5)[0],
+                "losses": self.loss_axes.plot([], [], color="black", linewidth=1)[0],
+                "duration": self.dur_axes.plot([], [], color="black", linewidth=1)[0],
+            }
+            self.best_line = self.rpe_axes.axhline(y=0, label="best", color="red", visible=False)
+            self.rpe_axes.set_title("Reward Per Episode")
+            self.loss_axes.set_title("Loss Per Episode")
+            self.dur_axes.set_title("Duration Per Episode")
+            for axes in ax:
+                axes.grid()
+
         plt.tight_layout()
         plt.ion()
-    
+
     def plot(
-        self, 
-        rewards: list[float], 
-        means: list[float], 
+        self,
+        rewards: list[float],
+        means: list[float],
         losses: list[float],
         best: float,
         duration: list[float],
@@ -36,7 +101,7 @@ class Plotter:
         self.rpe_axes.axhline(y=best, label="best",color="red")
         #self.rpe_axes.axhline(y=last, label="last", color="yellow")
         self.rpe_axes.grid()
-        
+
         self.loss_axes.clear()
         self.loss_axes.set_title("Loss Per Episode")
         self.loss_axes.plot(losses, color="black",linewidth=1)
@@ -46,12 +111,70 @@ class Plotter:
         self.dur_axes.plot(duration, color="black", linewidth=1)
         self.dur_axes.set_title("Duration Per Episode")
         self.dur_axes.grid()
-    
+
+    def extend(
+        self,
+        rewards: list[float],
+        means: list[float],
+        losses: list[float],
+        best: float,
+        duration: list[float],
+    ) -> None:
+        for key, values in zip(["rewards", "means", "losses", "duration"], [rewards, means, losses, duration]):
+            self.series[key].extend(values)
+            self.lines[key].set_data(*self.series[key].xy())
+        if best != -float("inf"):
+            self.best_line.set_ydata([best, best])
+            self.best_line.set_visible(True)
+        for axes in [self.rpe_axes, self.loss_axes, self.dur_axes]:
+            axes.relim()
+            axes.autoscale_view()
+
     def save(self, path: str) -> None:
-        plt.savefig(path)
-    
+        self.figure.savefig(path)
+
     def show(self) -> None:
         plt.pause(0.005)
 
 
+def plot_worker(updates: mp.SimpleQueue, path: str, points: int) -> None:
+    plt.switch_backend("Agg")
+    plotter = Plotter(points)
+    while True:
+        x = updates.get()
+        while x is not None:
+            plotter.extend(*x)
+            if updates.empty():
+                break
+            x = updates.get()
+        plotter.save(path)
+        if x is None:
+            return
+
+
+class PlotterProcess:
+
+    def __init__(self, path: str, points: int = 1000) -> None:
+        """
+        Downsampled `Plotter` rendering and saving to `path` in its own process.
+        `extend` only queues the new values, updates that pile up are drawn together.
+        A `SimpleQueue` writes from the caller, without the feeder thread of `Queue`,
+        so the training process can still fork for checkpoints.
+        """
+        self.updates = mp.SimpleQueue()
+        self.process = mp.Process(target=plot_worker, args=(self.updates, path, points), daemon=True)
+        self.process.start()
+
+    def extend(
+        self,
+        rewards: list[float],
+        means: list[float],
+        losses: list[float],
+        best: float,
+        duration: list[float],
+    ) -> None:
+        self.updates.put((rewards, means, losses, best, duration))
 
+    def close(self) -> None:
+        self.updates.put(None)
+        self.process.join()
@@ -1,10 +1,34 @@
 from typing import Any
 from serializable import Serializable
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import threading
+import time
+import traceback
+import warnings
+
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+
 
 class Plugin(Serializable):
 
-    def __init__(self) -> None:
-        pass
+    def __init__(self, interval: int = 1, mode: str = INLINE, max_backlog: int = 1) -> None:
+        """
+        Runs every `interval` steps of what it is plugged into.
+        Inline plugins get the object itself, thread and process plugins get its `snapshot`,
+        and are skipped while `max_backlog` of their runs are still unfinished.
+        A process plugin runs on a pickled copy of itself, so changes to its own state don't come back.
+        """
+        assert mode in (INLINE, THREAD, PROCESS), f"Unknown plugin mode {mode}"
+        self.interval = interval
+        self.mode = mode
+        self.max_backlog = max_backlog
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
 
     def step(self, attached: Any) -> Any:
         pass
@@ -12,19 +36,175 @@ class Plugin(Serializable):
     def reset(self, attached: Any) -> Any:
         pass
 
-class Pluggable(Serializable):
+
+class PluginStats:
 
     def __init__(self) -> None:
+        self.calls = 0
+        self.skipped = 0
+        self.errors = 0
+        self.backlog = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.last_error : BaseException = None
+
+    def add(self, ns: int) -> None:
+        self.calls += 1
+        self.total_ns += ns
+        self.max_ns = max(self.max_ns, ns)
+
+    def dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "backlog": self.backlog,
+            "mean_us": self.total_ns / max(self.calls, 1) / 1e3,
+            "max_us": self.max_ns / 1e3,
+            "last_error": None if self.last_error is None else repr(self.last_error)
+        }
+
+
+def timed_step(plugin: Plugin, attached: Any) -> int:
+    start = time.perf_counter_ns()
+    plugin.step(attached)
+    return time.perf_counter_ns() - start
+
+
+class Pluggable(Serializable):
+
+    def __init__(self, workers: int = 2) -> None:
+        """
+        Schedules plugins by step count. Steps where no plugin is due cost one comparison.
+        Thread and process plugins share pools of `workers`, created when first needed.
+        Process workers start from a forkserver, so process plugins and their module must be importable.
+        """
         self.plugins : list[Plugin] = []
+        self.workers = workers
+        self.steps = 0
+        self.due : list[int] = []
+        self.next_due = float("inf")
+        self.stats : list[PluginStats] = []
+        self.lock = threading.Lock()
+        self.threads : ThreadPoolExecutor = None
+        self.processes : ProcessPoolExecutor = None
 
     def step(self) -> None:
-        for plugin in self.plugins:
-            plugin.step(self)
-    
+        self.steps += 1
+        if self.steps < self.next_due:
+            return
+        for i, plugin in enumerate(self.plugins):
+            if self.due[i] <= self.steps:
+                self.due[i] = self.steps + plugin.interval
+                self.run(i, plugin)
+        self.next_due = min(self.due)
+
+    def run(self, i: int, plugin: Plugin) -> None:
+        stats = self.stats[i]
+        if plugin.mode == INLINE:
+            stats.add(timed_step(plugin, self))
+            return
+        with self.lock:
+            if stats.backlog >= plugin.max_backlog:
+                stats.skipped += 1
+                return
+            stats.backlog += 1
+        future = self.pool(plugin.mode).submit(timed_step, plugin, self.snapshot())
+        future.add_done_callback(lambda f: self.done(plugin, stats, f))
+
+    def done(self, plugin: Plugin, stats: PluginStats, future: Future) -> None:
+        """Inline plugins raise in `step`, the others warn with the traceback on their first error"""
+        error = future.exception()
+        with self.lock:
+            stats.backlog -= 1
+            if error is None:
+                stats.add(future.result())
+                return
+            stats.errors += 1
+            stats.last_error = error
+            first = stats.errors == 1
+        if first:
+            trace = "".join(traceback.format_exception(error))
+            warnings.warn(f"Plugin {plugin.name} failed, later errors are only counted:\n{trace}")
+
+    def pool(self, mode: str) -> ThreadPoolExecutor | ProcessPoolExecutor:
+        if mode == THREAD:
+            if self.threads is None:
+                self.threads = ThreadPoolExecutor(self.workers)
+            return self.threads
+        if self.processes is None:
+            # Not forked, the thread pool may be running plugins, and a fork can copy their held locks
+            self.processes = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        return self.processes
+
+    def snapshot(self) -> Any:
+        """What thread and process plugins get, must be picklable for process plugins"""
+        return self.serialize()
+
     def reset(self) -> None:
+        self.steps = 0
+        self.due = [plugin.interval for plugin in self.plugins]
+        self.next_due = min(self.due, default=float("inf"))
         for plugin in self.plugins:
             plugin.reset(self)
-    
+
     def plug(self, plugin: Plugin):
         self.plugins.append(plugin)
-    
\ No newline at end of file
+        self.stats.append(PluginStats())
+        self.due.append(self.steps + plugin.interval)
+        self.next_due = min(self.due)
+
+    def timings(self) -> dict[str, dict]:
+        with self.lock:
+            return {f"{i}:{plugin.name}": stats.dict() for i, (plugin, stats) in enumerate(zip(self.plugins, self.stats))}
+
+    def close(self) -> None:
+        for pool in (self.threads, self.processes):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        self.threads = None
+        self.processes = None
+
+
+# Self-test plugins, at module level so process workers can unpickle them
+class Sleep(Plugin):
+
+    def step(self, attached: Any) -> Any:
+        time.sleep(0.01)
+
+    def serialize(self) -> dict:
+        return {"interval": self.interval, "mode": self.mode}
+
+class Broken(Plugin):
+
+    def step(self, attached: Any) -> Any:
+        raise RuntimeError("broken plugin")
+
+    def serialize(self) -> dict:
+        return {"interval": self.interval, "mode": self.mode}
+
+
+if __name__ == "__main__":
+
+    class Counter(Pluggable):
+
+        def serialize(self) -> dict:
+            return {"steps": self.steps}
+
+    counter = Counter()
+    counter.plug(Sleep(10, INLINE))
+    counter.plug(Sleep(5, THREAD))
+    counter.plug(Sleep(5, PROCESS))
+    counter.plug(Broken(5, THREAD))
+    counter.reset()
+    start = time.perf_counter()
+    for _ in range(1000):
+        counter.step()
+    print(f"{(time.perf_counter() - start) * 1e3:.1f} ms for 1000 steps")
+    counter.close()
+    for name, stats in counter.timings().items():
+        print(name, stats)
+    assert counter.timings()["0:Sleep"]["calls"] == 100
+    assert counter.timings()["2:Sleep"]["calls"] > 0 and counter.timings()["2:Sleep"]["errors"] == 0
+    assert counter.timings()["3:Broken"]["errors"] > 0
+    assert isinstance(counter.stats[3].last_error, RuntimeError)
@@ -0,0 +1,100 @@
+import threading
+import queue
+import torch
+from replay_buffer import ReplayBuffer, TransitionBatch
+
+
+class Prefetcher:
+
+    def __init__(self, buffer: ReplayBuffer, batch_size: int, depth: int = 2) -> None:
+        """
+        Samples the next `depth` minibatches of `buffer` on a worker thread,
+        so gathering a batch overlaps with the gradient step on the previous one.
+        Stands in for the buffer in `Trainer`, pushes and priority updates go through to it.
+
+        Batches are copied into `depth + 2` reusable staging batches, one being filled,
+        `depth` waiting and one being trained on. Each sample is taken under the buffer's lock,
+        so concurrent pushes never show up half written.
+        With a prioritized buffer, priorities lag behind by up to `depth` batches.
+        """
+        self.buffer = buffer
+        self.bs = batch_size
+        self.depth = depth
+        self.queue : queue.Queue = queue.Queue(maxsize=depth)
+        self.slots : list[TransitionBatch] = []
+        self.thread = None
+        self.stopped = threading.Event()
+        self.k = 0
+        self.paused = False
+
+    def sample(self, count: int) -> TransitionBatch:
+        assert count == self.bs, f"Prefetcher samples batches of {self.bs}, got {count}"
+        if self.thread is None:
+            self.start()
+        x = self.queue.get()
+        if isinstance(x, BaseException):
+            raise x
+        return x
+
+    def start(self) -> None:
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def pause(self) -> None:
+        """Stops the worker, e.g. before a fork. Batches already waiting stay queued"""
+        self.paused = self.thread is not None
+        self.close()
+
+    def resume(self) -> None:
+        if self.paused:
+            self.start()
+        self.paused = False
+
+    def run(self) -> None:
+        # The slot counter outlives the thread, so a restarted worker doesn't fill slots still queued
+        while not self.stopped.is_set():
+            try:
+                x = self.stage(self.k, self.buffer.sample(self.bs))
+            except BaseException as e:
+                self.put(e)
+                return
+            self.k = (self.k + 1) % (self.depth + 2)
+            self.put(x)
+
+    def put(self, x) -> None:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(x, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def stage(self, k: int, batch: TransitionBatch) -> TransitionBatch:
+        if not self.slots:
+            self.slots = [
+                TransitionBatch(**{key: torch.empty_like(val) for key, val in batch.items()})
+                for _ in range(self.depth + 2)
+            ]
+        slot = self.slots[k]
+        for key, val in batch.items():
+            getattr(slot, key).copy_(val)
+        return slot
+
+    def push(self, o: TransitionBatch) -> None:
+        self.buffer.push(o)
+
+    def ep_reset(self) -> None:
+        self.buffer.ep_reset()
+
+    def update_priorities(self, indices: torch.Tensor, priorities: torch.Tensor) -> None:
+        self.buffer.update_priorities(indices, priorities)
+
+    def __len__(self) -> int:
+        return len(self.buffer)
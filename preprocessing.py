@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as tf
 from abc import ABC, abstractmethod
 from typing import Any
@@ -73,27 +74,82 @@ class Grayscale(WrappedProcessing):
 
 
 
+class FusedFrame(Preprocessing):
+
+    def __init__(self, img_size: tuple, grayscale: bool = True) -> None:
+        """
+        Raw uint8 frame(s) to normalized float in one pass. Does the work of
+        `ToPILImage`, `ToTensor`, `Resize` and `Grayscale`, without going through PIL.
+        Takes a [H, W, C] frame or a [B, H, W, C] batch of them, numpy or tensor.
+
+        Grayscale and the 1/255 scaling are one weighted sum over channels,
+        which commutes with the (linear) antialiased bilinear resize, so it runs first on 1 channel.
+        """
+        self.img_size = torch.Size(img_size)
+        self.grayscale = grayscale
+        # Same weights as torchvision's Grayscale
+        self.weights = torch.tensor([0.2989, 0.587, 0.114]) / 255
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = torch.as_tensor(x)
+        batched = x.dim() == 4
+        if not batched:
+            x = x.unsqueeze(0)
+
+        if self.grayscale:
+            x = torch.matmul(x.float(), self.weights.to(x.device)).unsqueeze(1)
+        else:
+            x = x.permute(0, 3, 1, 2).float().div_(255)
+        x = F.interpolate(x, size=tuple(self.img_size), mode="bilinear", antialias=True, align_corners=False)
+
+        return x if batched else x[0]
+
+    def size(self, size: torch.Size) -> torch.Size:
+        assert len(size) == 3, f"This method assumes input to be 3-dim, got {len(size)}"
+        w, h, c = size
+        return torch.Size([1 if self.grayscale else c]) + self.img_size
+
+
 class MultiFrame(Preprocessing):
 
-    def __init__(self, frames:int) -> None:
+    def __init__(self, frames:int, copy: bool = True) -> None:
+        """
+        Stacks the last `frames` frames along the channels, oldest first.
+        Frames go into a preallocated [batch, 2 * frames, C, H, W] buffer, each written twice,
+        at a rotating index and `frames` slots after it. The last `frames` frames are then
+        always one contiguous slice, so stacking needs no concatenation.
+
+        `copy` = False returns that slice as a view, which the next call overwrites.
+        """
         super().__init__()
 
         self.frames = frames
-        self.memory = []
-
-    def ep_reset(self) -> None:
-        self.memory.clear()
+        self.copy = copy
+        self.memory = None
+        self.index = 0
+
+    def ep_reset(self, mask: torch.Tensor = None) -> None:
+        """Zeros the frames of every environment, or only the ones in `mask`"""
+        if self.memory is None:
+            return
+        if mask is None:
+            self.memory.zero_()
+        else:
+            self.memory[mask] = 0
     
     def __call__(self, x: torch.Tensor) -> torch.Tensor:
         assert len(x.size()) == 4, f"Requires 4D tensor"
-        if not self.memory:
-            for i in range(self.frames):
-                self.memory.append(torch.zeros(x.size()))
-        
-        self.memory.append(x)
-        self.memory.pop(0)
+        b, *frame = x.size()
+        if self.memory is None or self.memory.size() != (b, 2 * self.frames, *frame):
+            self.memory = torch.zeros((b, 2 * self.frames, *frame), dtype=x.dtype, device=x.device)
+
+        i = self.index
+        self.memory[:, i] = x
+        self.memory[:, i + self.frames] = x
+        self.index = (i + 1) % self.frames
 
-        return torch.cat(self.memory, dim=1)
+        stack = self.memory[:, i + 1:i + 1 + self.frames].flatten(1, 2)
+        return stack.clone() if self.copy else stack
 
     def size(self, size: torch.Size) -> torch.Size:
         return torch.Size([size[0], size[1] * self.frames, *size[2:]])
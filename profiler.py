@@ -0,0 +1,249 @@
+from typing import Any, Callable
+from plugin import Plugin
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Histogram:
+    """
+    Fixed log-linear buckets of nanoseconds, 8 per power of two, so percentiles are within 12.5%.
+    Recording is a couple of integer ops, memory never grows.
+    """
+
+    buckets = 16 + 60 * 8
+
+    def __init__(self) -> None:
+        self.counts = [0] * self.buckets
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def index(ns: int) -> int:
+        if ns < 16:
+            return ns
+        b = ns.bit_length()
+        return 16 + (b - 5) * 8 + (ns >> (b - 4)) - 8
+
+    @staticmethod
+    def lower(i: int) -> int:
+        if i < 16:
+            return i
+        b = (i - 16) // 8 + 5
+        return ((i - 16) % 8 + 8) << (b - 4)
+
+    def add(self, ns: int) -> None:
+        self.counts[self.index(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def percentile(self, q: float) -> float:
+        """Middle of the bucket holding the `q` quantile"""
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= rank:
+                return (self.lower(i) + self.lower(i + 1)) / 2
+        return 0.0
+
+    def dict(self) -> dict:
+        return {
+            "count": self.count,
+            "total_ms": self.total / 1e6,
+            "mean_us": self.total / max(self.count, 1) / 1e3,
+            "p50_us": self.percentile(0.5) / 1e3,
+            "p90_us": self.percentile(0.9) / 1e3,
+            "p99_us": self.percentile(0.99) / 1e3,
+            "max_us": self.max / 1e3
+        }
+
+
+class NullSection:
+    """What `section` hands out while profiling is off"""
+
+    def __enter__(self) -> None:
+        pass
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+NULL_SECTION = NullSection()
+
+
+class Section:
+
+    def __init__(self, profiler: "Profiler", name: str) -> None:
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *args) -> None:
+        self.profiler.record(self.name, self.start, time.perf_counter_ns() - self.start)
+
+
+class Profiler:
+
+    def __init__(self, enabled: bool = False, trace: int = 1 << 16) -> None:
+        """
+        Nanosecond timers and counters by name, switched on and off at runtime.
+        Off, `section` returns a shared no-op and `count` returns after one check.
+        Times go to fixed `Histogram`s, and the last `trace` timed sections are kept for Chrome traces.
+        """
+        self.enabled = enabled
+        self.trace = trace
+        self.origin = time.perf_counter_ns()
+        self.reset()
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        self.histograms : dict[str, Histogram] = {}
+        self.counters : dict[str, int] = {}
+        self.events : list[tuple[str, int, int, int]] = [None] * self.trace
+        self.cursor = 0
+
+    def section(self, name: str) -> Section | NullSection:
+        if not self.enabled:
+            return NULL_SECTION
+        return Section(self, name)
+
+    def count(self, name: str, n: int = 1) -> None:
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name: str, start: int, ns: int) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(ns)
+        if self.trace:
+            self.events[self.cursor % self.trace] = (name, start, ns, threading.get_ident())
+            self.cursor += 1
+
+    def summary(self) -> dict:
+        """Flat per-name statistics, sorted by total time"""
+        timers = sorted(self.histograms.items(), key=lambda x: -x[1].total)
+        return {
+            "timers": {name: histogram.dict() for name, histogram in timers},
+            "counters": dict(self.counters)
+        }
+
+    def chrome_trace(self) -> dict:
+        """The kept sections as complete events, open in chrome://tracing or Perfetto"""
+        start = max(self.cursor - self.trace, 0)
+        events = [self.events[i % self.trace] for i in range(start, self.cursor)]
+        return {
+            "traceEvents": [
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": (begin - self.origin) / 1e3,
+                    "dur": ns / 1e3,
+                    "pid": os.getpid(),
+                    "tid": tid
+                }
+                for name, begin, ns, tid in events
+            ],
+            "displayTimeUnit": "ns"
+        }
+
+    def save(self, summary_path: str = None, trace_path: str = None) -> None:
+        if summary_path is not None:
+            with open(summary_path, "w") as f:
+                json.dump(self.summary(), f, indent=1)
+        if trace_path is not None:
+            with open(trace_path, "w") as f:
+                json.dump(self.chrome_trace(), f)
+
+
+PROFILER = Profiler()
+
+
+def profiled(name: str, profiler: Profiler = PROFILER) -> Callable:
+    """Decorator timing every call as `name`, e.g. on a `Base.step`"""
+    def wrap(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            if not profiler.enabled:
+                return fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.perf_counter_ns() - start)
+        return call
+    return wrap
+
+
+class ProfilerPlugin(Plugin):
+
+    def __init__(
+        self,
+        interval: int,
+        summary_path: str = None,
+        trace_path: str = None,
+        profiler: Profiler = PROFILER
+    ) -> None:
+        """Exports `profiler` every `interval` steps of what it is plugged into"""
+        super().__init__(interval)
+        self.summary_path = summary_path
+        self.trace_path = trace_path
+        self.profiler = profiler
+
+    def step(self, attached: Any) -> Any:
+        self.profiler.save(self.summary_path, self.trace_path)
+
+    def serialize(self) -> dict:
+        return {
+            "interval": self.interval,
+            "summary_path": self.summary_path,
+            "trace_path": self.trace_path
+        }
+
+
+if __name__ == "__main__":
+    histogram = Histogram()
+    for ns in range(1, 100001):
+        histogram.add(ns)
+    for q in [0.5, 0.9, 0.99]:
+        assert abs(histogram.percentile(q) / (q * 100000) - 1) < 0.125, (q, histogram.percentile(q))
+
+    profiler = Profiler(trace=100)
+    count = 100000
+    for enabled in [False, True]:
+        profiler.enabled = enabled
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            with profiler.section("loop"):
+                pass
+        print(f"section, enabled={enabled}: {(time.perf_counter_ns() - start) / count:.0f} ns")
+
+    @profiled("fn", profiler)
+    def fn() -> None:
+        pass
+
+    for enabled in [False, True]:
+        profiler.enabled = enabled
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            fn()
+        print(f"profiled, enabled={enabled}: {(time.perf_counter_ns() - start) / count:.0f} ns")
+
+    summary = profiler.summary()
+    assert summary["timers"]["loop"]["count"] == count
+    assert len(profiler.chrome_trace()["traceEvents"]) == 100
+    print(json.dumps(summary, indent=1))
@@ -1,23 +1,32 @@
 from base import Base
-import matplotlib.pyplot as plt
+from collections import deque
+from itertools import islice
+import json
+import torch
 
 
 class Recorder():
 
-    def __init__(self, mean_duration: int, record_interval: int) -> None:
+    def __init__(self, mean_duration: int, record_interval: int, history: int = 10000, path: str = None) -> None:
+        """
+        Rewards and losses are summed where they are, tensors stay on their device,
+        and read back once every `record_interval` steps.
+        Only the last `history` records and episodes are kept in memory,
+        the whole history is appended to `path` as json lines if given.
+        """
         super().__init__()
 
         self.mean_duration = mean_duration
         self.record_interval = record_interval
-        self.rewards = []
-        self.means = []
-        self.losses = []
-        self.accum_rewards = []
-        self.accum_means = []
-        self.accum_losses = []
-        self.ep_duration = []
-    
-    def step(self, reward: float, loss: float):
+        self.path = path
+        self.file = None
+        self.rewards = deque(maxlen=history)
+        self.means = deque(maxlen=history)
+        self.losses = deque(maxlen=history)
+        self.ep_duration = deque(maxlen=history)
+        self.window = deque(maxlen=mean_duration)
+
+    def step(self, reward: torch.Tensor | float, loss: torch.Tensor | float):
         self.steps += 1
         self.accumulate(reward, loss)
         if self.steps % self.record_interval == 0:
@@ -29,35 +38,120 @@ class Recorder():
         self.means.clear()
         self.losses.clear()
         self.ep_duration.clear()
+        self.window.clear()
+        self.window_sum = 0.0
 
         self.steps = 0
+        self.records = 0
+        self.episodes = 0
+        self.sent_records = 0
+        self.sent_episodes = 0
         self.best = -float('inf')
         self.reset_accumulated()
 
+    def on_episode_end(self, duration: int) -> None:
+        self.episodes += 1
+        self.ep_duration.append(duration)
+        self.write({"episode": self.episodes, "duration": duration})
 
     def reset_accumulated(self) -> None:
-        self.accum_rewards.clear()
-        self.accum_means.clear()
-        self.accum_losses.clear()
-
-    def last_mean(self, r: list[float] = None) -> float:
-        if not r:
-            r = self.rewards
-        return sum(r[-self.mean_duration:])/len(r[-self.mean_duration:])
-    
-    def accumulate(self, reward: float, loss: float) -> None:
-        
-        self.accum_rewards.append(reward)
-        self.accum_losses.append(loss)
+        self.accum_reward = 0.0
+        self.accum_loss = 0.0
+
+    def last_mean(self) -> float:
+        """Mean of the last `mean_duration` records"""
+        return self.window_sum / max(len(self.window), 1)
+
+    def accumulate(self, reward: torch.Tensor | float, loss: torch.Tensor | float) -> None:
+        if isinstance(reward, torch.Tensor):
+            reward = reward.detach().sum()
+        if isinstance(loss, torch.Tensor):
+            loss = loss.detach().sum()
+        self.accum_reward = self.accum_reward + reward
+        self.accum_loss = self.accum_loss + loss
 
     def aggregate(self) -> None:
-        
-        self.rewards.append(sum(self.accum_rewards))
-        self.losses.append(sum(self.accum_losses))
+        reward, loss = self.accum_reward, self.accum_loss
+        tensors = [x for x in (reward, loss) if isinstance(x, torch.Tensor)]
+        if tensors:
+            values = iter(torch.stack([x.float().cpu() for x in tensors]).tolist())
+            reward = next(values) if isinstance(reward, torch.Tensor) else reward
+            loss = next(values) if isinstance(loss, torch.Tensor) else loss
+        self.record(reward, loss)
+
+    def record(self, reward: float, loss: float) -> None:
+        self.records += 1
+        if len(self.window) == self.window.maxlen:
+            self.window_sum -= self.window[0]
+        self.window.append(reward)
+        self.window_sum += reward
+
+        self.rewards.append(reward)
+        self.losses.append(loss)
         self.means.append(self.last_mean())
 
-        if self.rewards[-1] > self.best:
-            self.best = self.rewards[-1]
+        if reward > self.best:
+            self.best = reward
+        self.write({"step": self.steps, "reward": reward, "mean": self.means[-1], "loss": loss})
+
+    def write(self, row: dict) -> None:
+        if self.path is None:
+            return
+        if self.file is None:
+            self.file = open(self.path, "a")
+        self.file.write(json.dumps(row) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def state_dict(self) -> dict:
+        """Reads back what was accumulated since the last record"""
+        accum = [float(x) for x in (self.accum_reward, self.accum_loss)]
+        return {
+            "steps": self.steps,
+            "records": self.records,
+            "episodes": self.episodes,
+            "best": self.best,
+            "window": list(self.window),
+            "window_sum": self.window_sum,
+            "accumulated": accum,
+            "rewards": list(self.rewards),
+            "means": list(self.means),
+            "losses": list(self.losses),
+            "ep_duration": list(self.ep_duration)
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        self.steps = state["steps"]
+        self.records = state["records"]
+        self.episodes = state["episodes"]
+        self.sent_records = 0
+        self.sent_episodes = 0
+        self.best = state["best"]
+        self.window = deque(state["window"], maxlen=self.mean_duration)
+        self.window_sum = state["window_sum"]
+        self.accum_reward, self.accum_loss = state["accumulated"]
+        for key in ["rewards", "means", "losses", "ep_duration"]:
+            getattr(self, key).clear()
+            getattr(self, key).extend(state[key])
+
+    def data(self) -> tuple[list[float], list[float], list[float], float, list[int]]:
+        return list(self.rewards), list(self.means), list(self.losses), self.best, list(self.ep_duration)
 
-    def data(self) -> tuple[list[float], list[float], list[float], float]:
-        return self.rewards, self.means, self.losses, self.best, self.ep_duration
+    def new_data(self) -> tuple[list[float], list[float], list[float], float, list[int]]:
+        """Like `data`, but only what was recorded since the last call"""
+        records = min(self.records - self.sent_records, len(self.rewards))
+        episodes = min(self.episodes - self.sent_episodes, len(self.ep_duration))
+        self.sent_records = self.records
+        self.sent_episodes = self.episodes
+        tail = lambda x, n: list(islice(x, len(x) - n, None))
+        return (
+            tail(self.rewards, records),
+            tail(self.means, records),
+            tail(self.losses, records),
+            self.best,
+            tail(self.ep_duration, episodes)
+        )
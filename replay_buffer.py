@@ -1,45 +1,68 @@
 from serializable import Serializable
+from segment_tree import SumTree, MinTree
+from compression import Codec
 from abc import abstractmethod
 import torch
-from dataclasses import dataclass
-
-@dataclass
-class Transition:
-
-    s_now : list[torch.FloatTensor]
-    a: list[torch.IntTensor]
-    r: list[torch.FloatTensor]
-    s_next : list[torch.FloatTensor]
-    done: list[torch.BoolTensor]
-
-    def __getitem__(self, indices) -> "Transition":
-        x = self.dict()
-        for key, val in x.items():
-            x[key] = [val[i] for i in indices]
-        return Transition(**x)
-
-    def tuple(self) -> tuple[list[torch.FloatTensor],
-                             list[torch.IntTensor],
-                             list[torch.FloatTensor],
-                             list[torch.FloatTensor],
-                             list[torch.BoolTensor]]:
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+
+class TransitionBatch:
+    """
+    Columnar batch of transitions, one tensor per field with the batch in dim 0.
+    A single transition is a batch of one.
+    Indexing with an int or a slice returns views, nothing is copied.
+    """
+
+    __slots__ = ["s_now", "a", "r", "s_next", "done", "weights", "indices", "discount"]
+
+    def __init__(
+        self,
+        s_now: torch.FloatTensor,
+        a: torch.IntTensor,
+        r: torch.FloatTensor,
+        s_next: torch.FloatTensor,
+        done: torch.BoolTensor,
+        weights: torch.FloatTensor = None,
+        indices: torch.LongTensor = None,
+        discount: torch.FloatTensor = None
+    ) -> None:
+        self.s_now = s_now
+        self.a = a
+        self.r = r
+        self.s_next = s_next
+        self.done = done
+        # Only set on sampled batches of prioritized buffers
+        self.weights = weights
+        self.indices = indices
+        # gamma^n, zero once done. Only set by `NStepWindow`
+        self.discount = discount
+
+    def __len__(self) -> int:
+        return self.a.size(0)
+
+    def __getitem__(self, index) -> "TransitionBatch":
+        if isinstance(index, int):
+            index = slice(index, index + 1)
+        return TransitionBatch(**{key: val[index] for key, val in self.items()})
+
+    def items(self) -> list[tuple[str, torch.Tensor]]:
+        """Every field that is set, optional ones included"""
+        return [(key, getattr(self, key)) for key in self.__slots__ if getattr(self, key) is not None]
+
+    def __iter__(self):
+        return iter(self.tuple())
+
+    def tuple(self) -> tuple[torch.FloatTensor,
+                             torch.IntTensor,
+                             torch.FloatTensor,
+                             torch.FloatTensor,
+                             torch.BoolTensor]:
         return self.s_now, self.a, self.r, self.s_next, self.done
 
-    def push(self, transition: "Transition") -> None:
-        
-        for key in self.keys():
-            getattr(self, key).append(getattr(transition, key))
-    
-    def pop(self, i: int) -> None:
-        for key in self.keys():
-            getattr(self, key).pop(i)
-    
-    def cat(self) -> "Transition":
-        d = {}
-        for key in self.keys():
-            d[key] = torch.cat(getattr(self,key))
-        return Transition(**d)
-    
     def keys(self) -> list[str]:
         return ["s_now", "a", "r", "s_next", "done"]
 
@@ -51,84 +74,778 @@ class Transition:
             "s_next": self.s_next,
             "done": self.done
         }
-    
+
     @staticmethod
-    def empty() -> "Transition":
-        return Transition([],[],[],[],[])
+    def cat(batches: list["TransitionBatch"]) -> "TransitionBatch":
+        keys = [key for key, _ in batches[0].items()]
+        return TransitionBatch(**{key: torch.cat([getattr(x, key) for x in batches]) for key in keys})
+
+    def to(self, device: torch.device, non_blocking: bool = False) -> "TransitionBatch":
+        return TransitionBatch(**{key: val.to(device, non_blocking=non_blocking) for key, val in self.items()})
+
+    def pin_memory(self) -> "TransitionBatch":
+        return TransitionBatch(**{key: val.pin_memory() for key, val in self.items()})
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{key}={tuple(val.size())}" for key, val in self.items())
+        return f"TransitionBatch({fields})"
+
+
+class NStepWindow:
+
+    def __init__(self, n: int, gamma: float) -> None:
+        """
+        Turns 1-step transitions into n-step ones as they are pushed.
+        Keeps the last `n` transitions. Once the window is full, the oldest one
+        leaves with the discounted sum of rewards up to the first `done`,
+        the newest `s_next`, and `discount` = gamma^n, or 0 if the episode ended in between.
+        Each row of the batch is its own environment, rows are computed together.
+
+        Rewards and dones go to preallocated [n, batch, 1] rings, states are only referenced.
+        """
+        self.n = n
+        self.gamma = gamma
+        self.states : deque[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = deque()
+        self.r = None
+        self.done = None
+        self.pos = 0
+        self.gammas = gamma ** torch.arange(n, dtype=torch.float32).view(-1, 1, 1)
+
+    def push(self, o: TransitionBatch) -> list[TransitionBatch]:
+        if self.r is None:
+            self.r = torch.empty((self.n, *o.r.size()), dtype=o.r.dtype, device=o.r.device)
+            self.done = torch.empty((self.n, *o.done.size()), dtype=o.done.dtype, device=o.done.device)
+            self.gammas = self.gammas.to(o.r.device)
+
+        self.r[self.pos].copy_(o.r)
+        self.done[self.pos].copy_(o.done)
+        self.pos = (self.pos + 1) % self.n
+        self.states.append((o.s_now, o.a, o.s_next))
+
+        if len(self.states) < self.n:
+            return []
+        x = self.emit()
+        self.states.popleft()
+        return [x]
+
+    def flush(self) -> list[TransitionBatch]:
+        """Empties the window with shorter returns, for when the episode was cut without a `done`"""
+        out = []
+        while self.states:
+            out.append(self.emit())
+            self.states.popleft()
+        return out
+
+    def emit(self) -> TransitionBatch:
+        m = len(self.states)
+        order = (torch.arange(m) + self.pos - m) % self.n
+        order = order.to(self.r.device)
+        r = self.r.index_select(0, order)
+        done = self.done.index_select(0, order)
+
+        # rewards after a `done` belong to the next episode
+        alive = done.logical_not().cumprod(dim=0)
+        before = torch.cat([torch.ones_like(alive[:1]), alive[:-1]])
+        returns = (self.gammas[:m] * before * r).sum(dim=0)
+        discount = self.gamma ** m * alive[-1].to(r.dtype)
+
+        s_now, a, _ = self.states[0]
+        return TransitionBatch(
+            s_now,
+            a,
+            returns,
+            self.states[-1][2],
+            alive[-1].logical_not(),
+            discount=discount
+        )
+
+
+class RingStorage:
+    """
+    Preallocated storage, one contiguous tensor per field.
+    Rows are written in place, so nothing is allocated after the first write.
+    Tensors are allocated lazily, because row shapes are only known once data arrives.
+
+    `dtypes` overrides the stored dtype of a field. Floats stored as uint8 are
+    quantized from [0, 1] to [0, 255] on write, `decode` turns them back.
+    """
+
+    def __init__(self, capacity: int, dtypes: dict[str, torch.dtype] = None) -> None:
+        self.capacity = capacity
+        self.dtypes = dtypes or {}
+        self.sources : dict[str, torch.dtype] = {}
+        self.fields : dict[str, torch.Tensor] = {}
+
+    def allocate(self, key: str, size: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        return torch.empty((self.capacity, *size), dtype=dtype)
+
+    def write(self, start: int, rows: dict[str, torch.Tensor]) -> None:
+        """Write rows starting at slot `start`, wrapping around the end"""
+        if not self.fields:
+            for key, val in rows.items():
+                self.sources[key] = val.dtype
+                dtype = self.dtypes.get(key, val.dtype)
+                self.fields[key] = self.allocate(key, val.size()[1:], dtype)
+
+        for key, val in rows.items():
+            field = self.fields[key]
+            val = self.encode(key, val)
+            n = val.size(0)
+            head = min(n, self.capacity - start)
+            field[start:start + head].copy_(val[:head])
+            if head < n:
+                field[:n - head].copy_(val[head:])
+
+    def read(self, indices: torch.Tensor, keys: list[str] = None, pin_memory: bool = False) -> dict[str, torch.Tensor]:
+        """Returns rows as stored, run them through `decode` to get the pushed dtype back"""
+        if keys is None:
+            keys = self.fields.keys()
+        x = {}
+        for key in keys:
+            field = self.fields[key]
+            out = torch.empty((len(indices), *field.size()[1:]), dtype=field.dtype, pin_memory=pin_memory)
+            x[key] = torch.index_select(field, 0, indices, out=out)
+        return x
+
+    def encode(self, key: str, val: torch.Tensor) -> torch.Tensor:
+        return quantize(val, self.fields[key].dtype)
+
+    def decode(self, key: str, val: torch.Tensor) -> torch.Tensor:
+        source = self.sources[key]
+        if val.dtype == torch.uint8 and source.is_floating_point:
+            return val.to(source).div_(255)
+        return val.to(source)
+
+    def state_dict(self) -> dict:
+        return {"fields": dict(self.fields), "sources": dict(self.sources)}
+
+    def load_state_dict(self, state: dict) -> None:
+        """Takes the tensors as they are, so memory-mapped ones stay mapped until written"""
+        for key, val in state["fields"].items():
+            assert val.size(0) == self.capacity, f"{key} was saved with capacity {val.size(0)}"
+        self.fields = dict(state["fields"])
+        self.sources = dict(state["sources"])
+
+
+def quantize(val: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Scales [0, 1] floats to [0, 255] if they are going to be stored as uint8"""
+    if dtype == torch.uint8 and val.is_floating_point():
+        return val.mul(255).round_().clamp_(0, 255)
+    return val
+
+
+class MemmapStorage(RingStorage):
+    """
+    Same as `RingStorage`, but every field is a preallocated file under `path`, mapped into memory.
+    Field shapes and dtypes go to `meta.json` on allocation, so an existing directory can be reopened.
+    """
+
+    def __init__(self, path: str, capacity: int, dtypes: dict[str, torch.dtype] = None) -> None:
+        super().__init__(capacity, dtypes)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            assert meta["capacity"] == capacity, f"{path} was created with capacity {meta['capacity']}"
+            for key, field in meta["fields"].items():
+                self.sources[key] = to_dtype(field["source"])
+                self.fields[key] = self.map(key, torch.Size(field["size"]), to_dtype(field["dtype"]))
+
+    def allocate(self, key: str, size: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        return self.map(key, size, dtype)
+
+    def map(self, key: str, size: torch.Size, dtype: torch.dtype) -> torch.Tensor:
+        numel = self.capacity * size.numel()
+        x = torch.from_file(os.path.join(self.path, f"{key}.bin"), shared=True, size=numel, dtype=dtype)
+        return x.view(self.capacity, *size)
+
+    def save_meta(self) -> None:
+        meta = {
+            "capacity": self.capacity,
+            "fields": {
+                key: {
+                    "size": list(val.size()[1:]),
+                    "dtype": str(val.dtype),
+                    "source": str(self.sources[key])
+                }
+                for key, val in self.fields.items()
+            }
+        }
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    def write(self, start: int, rows: dict[str, torch.Tensor]) -> None:
+        allocating = not self.fields
+        super().write(start, rows)
+        if allocating:
+            self.save_meta()
+
+    def flush(self) -> None:
+        """Writes the mapped pages that changed back to the files"""
+        for key in self.fields:
+            with open(os.path.join(self.path, f"{key}.bin"), "rb+") as f:
+                os.fsync(f.fileno())
+
+    def state_dict(self) -> dict:
+        """
+        The files are the state, so this flushes them and points at them instead of returning the mappings,
+        which would be copied into memory or, when forked, keep changing under the writer.
+        Rows written after the checkpoint stay in the files.
+        """
+        self.flush()
+        return {"path": os.path.abspath(self.path), "sources": dict(self.sources)}
+
+    def load_state_dict(self, state: dict) -> None:
+        """Copies into the mapped files, unless they are the files the state points at"""
+        self.sources = dict(state["sources"])
+        if "path" in state:
+            if os.path.exists(self.path) and os.path.samefile(state["path"], self.path):
+                return
+            fields = MemmapStorage(state["path"], self.capacity).fields
+        else:
+            fields = state["fields"]
+        for key, val in fields.items():
+            if key not in self.fields:
+                self.fields[key] = self.map(key, val.size()[1:], val.dtype)
+            self.fields[key].copy_(val)
+        self.save_meta()
+
+
+def to_dtype(name: str) -> torch.dtype:
+    """'torch.uint8' -> torch.uint8"""
+    return getattr(torch, name.split(".")[-1])
+
+
+class CompressedStorage(RingStorage):
+    """
+    Same as `RingStorage`, except `keys` are compressed row by row with `codec` on write.
+    Rows are decompressed on a thread pool when read, codecs release the GIL while they work.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        codec: Codec,
+        keys: list[str],
+        dtypes: dict[str, torch.dtype] = None,
+        workers: int = None
+    ) -> None:
+        super().__init__(capacity, dtypes)
+        self.codec = codec
+        self.keys = keys
+        self.blobs : dict[str, list[bytes]] = {}
+        self.sizes : dict[str, torch.Size] = {}
+        self.stored : dict[str, torch.dtype] = {}
+        self.workers = workers or min(8, os.cpu_count() or 1)
+        self.pool = ThreadPoolExecutor(self.workers)
+
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.decode_ns = 0
+        self.decoded_rows = 0
+
+    def write(self, start: int, rows: dict[str, torch.Tensor]) -> None:
+        compressed = {key: val for key, val in rows.items() if key in self.keys}
+        super().write(start, {key: val for key, val in rows.items() if key not in self.keys})
+
+        for key, val in compressed.items():
+            if key not in self.blobs:
+                self.sources[key] = val.dtype
+                self.stored[key] = self.dtypes.get(key, val.dtype)
+                self.sizes[key] = val.size()[1:]
+                self.blobs[key] = [None] * self.capacity
+
+            blobs = self.blobs[key]
+            val = quantize(val, self.stored[key]).to("cpu", self.stored[key]).contiguous()
+            for j in range(val.size(0)):
+                i = (start + j) % self.capacity
+                row = val[j].numpy()
+                blob = self.codec.encode(memoryview(row).cast("B"))
+                if blobs[i] is not None:
+                    self.raw_bytes -= row.nbytes
+                    self.compressed_bytes -= len(blobs[i])
+                self.raw_bytes += row.nbytes
+                self.compressed_bytes += len(blob)
+                blobs[i] = blob
+
+    def read(self, indices: torch.Tensor, keys: list[str] = None, pin_memory: bool = False) -> dict[str, torch.Tensor]:
+        if keys is None:
+            keys = [*self.fields.keys(), *self.blobs.keys()]
+        x = super().read(indices, [key for key in keys if key not in self.keys], pin_memory)
+        for key in keys:
+            if key in self.keys:
+                x[key] = self.decompress(key, indices, pin_memory)
+        return x
+
+    def decompress(self, key: str, indices: torch.Tensor, pin_memory: bool = False) -> torch.Tensor:
+        start = time.perf_counter_ns()
+        blobs = self.blobs[key]
+        slots = indices.tolist()
+        out = torch.empty((len(slots), *self.sizes[key]), dtype=self.stored[key], pin_memory=pin_memory)
+
+        def decode(rows: range) -> None:
+            for j in rows:
+                # Slots that were never written are read as zeros, e.g. frames before an episode
+                if blobs[slots[j]] is None:
+                    out[j].zero_()
+                else:
+                    memoryview(out[j].numpy()).cast("B")[:] = self.codec.decode(blobs[slots[j]])
+
+        chunk = -(-len(slots) // self.workers)
+        list(self.pool.map(decode, [range(k, min(k + chunk, len(slots))) for k in range(0, len(slots), chunk)]))
+
+        self.decode_ns += time.perf_counter_ns() - start
+        self.decoded_rows += len(indices)
+        return out
+
+    def state_dict(self) -> dict:
+        x = super().state_dict()
+        x["blobs"] = {key: list(val) for key, val in self.blobs.items()}
+        x["sizes"] = {key: list(val) for key, val in self.sizes.items()}
+        x["stored"] = dict(self.stored)
+        x["raw_bytes"] = self.raw_bytes
+        x["compressed_bytes"] = self.compressed_bytes
+        return x
+
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        self.blobs = {key: list(val) for key, val in state["blobs"].items()}
+        self.sizes = {key: torch.Size(val) for key, val in state["sizes"].items()}
+        self.stored = dict(state["stored"])
+        self.raw_bytes = state["raw_bytes"]
+        self.compressed_bytes = state["compressed_bytes"]
+
+    def stats(self) -> dict:
+        return {
+            "compression_ratio": self.raw_bytes / max(self.compressed_bytes, 1),
+            "compressed_bytes": self.compressed_bytes,
+            "decode_us_per_row": self.decode_ns / 1000 / max(self.decoded_rows, 1)
+        }
+
 
 class ReplayBuffer(Serializable):
+
+    obs_keys = ["s_now", "s_next"]
     
     def __init__(
         self, 
         capacity: int,
-        device: torch.device
+        device: torch.device,
+        obs_dtype: torch.dtype = None,
+        dtypes: dict[str, torch.dtype] = None,
+        codec: Codec = None,
+        n_step: int = 1,
+        gamma: float = None,
+        pin_memory: bool = False
     ) -> None:
         """
-        Receives an empty transition. Required to specify dimensions.
+        Fields are allocated on the first push. Required to specify dimensions.
         Saves in CPU memory,
         Returns in device
+
+        `obs_dtype` is the stored dtype of observations, `torch.uint8` keeps [0, 1] frames as bytes.
+        `dtypes` does the same per field, e.g. {"r": torch.float16}
+        `codec` compresses observations row by row, see `CompressedStorage`
+        `n_step` > 1 stores n-step transitions with their `discount`, see `NStepWindow`
+        `pin_memory` gathers sampled batches into page-locked memory, for asynchronous copies to the GPU
         """
         super().__init__()
 
         self.device =device
         self.capacity = capacity
-        self.transitions = Transition.empty()
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        dtypes = dict(dtypes or {})
+        if obs_dtype is not None:
+            for key in self.obs_keys:
+                dtypes.setdefault(key, obs_dtype)
+        if codec is None:
+            self.storage = RingStorage(capacity, dtypes)
+        else:
+            self.storage = CompressedStorage(capacity, codec, self.obs_keys, dtypes)
+        self.cursor = 0
+        self.count = 0
+        # Held while rows are written or sampled, so other threads can sample while pushing
+        self.lock = threading.RLock()
+        self.window = None
+        if n_step > 1:
+            assert gamma is not None, "n-step returns require gamma"
+            self.window = NStepWindow(n_step, gamma)
     
-    def sample(self, count: int) -> Transition:
+    def sample(self, count: int) -> TransitionBatch:
         """
         Could return same rows multiple times. But, whatever, right? Let the py-god select it for us
         """
-        indices = torch.randint(0, len(self), (count,))
-        x = self.transitions[indices].cat()
-        return x.tuple()
+        with self.lock:
+            return self.gather(self.sample_indices(count))
 
-    def push(self, o: Transition) -> None:
+    def gather(self, indices: torch.Tensor) -> TransitionBatch:
+        x = self.storage.read(indices, pin_memory=self.pin_memory)
+        x = {key: self.storage.decode(key, self.to_device(val)) for key, val in x.items()}
+        return TransitionBatch(**x)
+
+    def to_device(self, x: torch.Tensor) -> torch.Tensor:
+        return x.to(self.device, non_blocking=self.pin_memory)
+
+    def sample_indices(self, count: int) -> torch.Tensor:
+        return torch.randint(0, self.count, (count,))
+
+    def push(self, o: TransitionBatch) -> None:
         """
-        Push new transition and if the resulting buffer size is larger than the capacity, pop the first element
+        Push new transitions, one row per environment.
+        If the buffer is full, they overwrite the rows starting at `pop_index`
         """
-        assert o.a.size(dim=0) == 1, "Input batch size must be 1"
+        with self.lock:
+            if self.window is None:
+                self.write(self.rows(o))
+                return
+            for x in self.window.push(o):
+                self.write(self.rows(x))
 
-        self.transitions.push(o)
+    def rows(self, o: TransitionBatch) -> dict[str, torch.Tensor]:
+        return dict(o.items())
+
+    def write(self, rows: dict[str, torch.Tensor]) -> int:
+        """Writes a batch of rows to consecutive slots, returns the first one"""
+        n = next(iter(rows.values())).size(0)
+        i = self.pop_index() if self.count + n > self.capacity else self.cursor
+        self.storage.write(i, rows)
+
+        self.cursor = (i + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+        return i
 
-        if (len(self) >= self.capacity):
-            i = self.pop_index()
-            self.transitions.pop(i)
-        
     def pop_index(self) -> int:
-        """Base replay buffer is a FIFO, so it pops the first element"""
-        return 0
+        """Base replay buffer is a FIFO, so it overwrites the oldest rows, which is where the cursor is"""
+        return self.cursor
+
+    def update_priorities(self, indices: torch.Tensor, priorities: torch.Tensor) -> None:
+        """Uniform buffer has no priorities"""
+        pass
+
+    def ep_reset(self) -> None:
+        """Episode reset"""
+        if self.window is None:
+            return
+        with self.lock:
+            for x in self.window.flush():
+                self.write(self.rows(x))
 
     def __len__(self) -> int:
-        return len(self.transitions.a)
+        return self.count
+
+    def state_dict(self) -> dict:
+        """Rows still waiting in the n-step window are not included"""
+        return {"cursor": self.cursor, "count": self.count, "storage": self.storage.state_dict()}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.storage.load_state_dict(state["storage"])
+        self.cursor = state["cursor"]
+        self.count = state["count"]
 
     def serialize(self) -> dict:
-        return {
-            "capacity": self.capacity,
-            "s_now_size": self.transitions.s_now.size()[1:],
-            "a_size": self.transitions.a.size()[1:],
-            "r_size": self.transitions.r.size()[1:],
-            "s_next_size": self.transitions.s_next.size()[1:],
-            "done_size": self.transitions.done.size()[1:]
-        }
+        x = {"capacity": self.capacity}
+        for key, val in self.storage.fields.items():
+            x[f"{key}_size"] = val.size()[1:]
+        return x
+
+class FrameReplayBuffer(ReplayBuffer):
+
+    obs_keys = ["frame"]
+
+    def __init__(
+        self,
+        capacity: int,
+        device: torch.device,
+        frames: int,
+        obs_dtype: torch.dtype = None,
+        dtypes: dict[str, torch.dtype] = None,
+        codec: Codec = None
+    ) -> None:
+        """
+        Stores each frame once, instead of the full `s_now` and `s_next` stacks of `MultiFrame`.
+        A row holds the newest frame of `s_next` along with its `a`, `r` and `done`,
+        and the stacks are rebuilt from neighbouring rows when sampled.
+
+        The first state of an episode takes a padding row of its own, which is never sampled.
+        `ep_pos` is the position of a frame in its episode. Frames further back than that
+        are zeros, same as `MultiFrame` pads after `ep_reset`.
+        Requires `ep_reset` to be called whenever the environment is reset.
+
+        `len` counts only the rows that can be sampled, so padding rows are left out.
+        """
+        super().__init__(capacity, device, obs_dtype, dtypes, codec)
+        self.frames = frames
+        self.ep_step = 0
+        self.new_episode = True
+        self.padding = 0
+
+    def push(self, o: TransitionBatch) -> None:
+        assert o.a.size(dim=0) == 1, "Input batch size must be 1"
+
+        with self.lock:
+            self.write_frames(o)
+
+    def write_frames(self, o: TransitionBatch) -> None:
+        c = o.s_next.size(1) // self.frames
+        if self.new_episode:
+            self.ep_step = 0
+            self.write({
+                "frame": o.s_now[:, -c:],
+                "a": torch.zeros_like(o.a),
+                "r": torch.zeros_like(o.r),
+                "done": torch.zeros_like(o.done),
+                "ep_pos": torch.tensor([self.ep_step], dtype=torch.int32)
+            })
+            self.new_episode = False
+
+        self.ep_step += 1
+        self.write({
+            "frame": o.s_next[:, -c:],
+            "a": o.a,
+            "r": o.r,
+            "done": o.done,
+            "ep_pos": torch.tensor([self.ep_step], dtype=torch.int32)
+        })
+
+    def write(self, rows: dict[str, torch.Tensor]) -> int:
+        """Keeps count of the padding rows, the ones written and the ones overwritten"""
+        if self.count >= self.capacity and self.storage.fields["ep_pos"][self.pop_index()].item() == 0:
+            self.padding -= 1
+        if rows["ep_pos"].item() == 0:
+            self.padding += 1
+        return super().write(rows)
+
+    def ep_reset(self) -> None:
+        self.new_episode = True
+
+    def __len__(self) -> int:
+        """Rows that can be sampled, leaving out padding and rows whose earlier frames were overwritten"""
+        return self.count - self.padding - self.unstackable()
+
+    def unstackable(self) -> int:
+        """Only the oldest `frames` rows of a full buffer can have lost their earlier frames"""
+        if self.count < self.capacity:
+            return 0
+        head = (self.cursor + torch.arange(min(self.frames, self.capacity))) % self.capacity
+        ep_pos = self.storage.fields["ep_pos"].index_select(0, head)
+        return int(((ep_pos > 0) & ~self.is_valid(head)).sum())
+
+    def gather(self, indices: torch.Tensor) -> TransitionBatch:
+        ep_pos = self.storage.fields["ep_pos"].index_select(0, indices)
+
+        x = self.storage.read(indices, ["a", "r", "done"], self.pin_memory)
+        x = {key: self.storage.decode(key, self.to_device(val)) for key, val in x.items()}
+        s_now = self.to_device(self.stack((indices - 1) % self.capacity, ep_pos - 1))
+        s_next = self.to_device(self.stack(indices, ep_pos))
+        x["s_now"] = self.storage.decode("frame", s_now)
+        x["s_next"] = self.storage.decode("frame", s_next)
+        return TransitionBatch(**x)
+
+    def sample_indices(self, count: int) -> torch.Tensor:
+        """Uniform over the rows that are not padding, redraws the ones that are"""
+        if len(self) == 0:
+            raise ValueError("No rows to sample, only padding or episodes shorter than the frame stack")
+        indices = super().sample_indices(count)
+        invalid = ~self.is_valid(indices)
+        while invalid.any():
+            indices[invalid] = super().sample_indices(int(invalid.sum()))
+            invalid = ~self.is_valid(indices)
+        return indices
+
+    def is_valid(self, indices: torch.Tensor) -> torch.Tensor:
+        """
+        Padding rows are not transitions. Rows whose earlier frames
+        were already overwritten can't be stacked anymore.
+        """
+        ep_pos = self.storage.fields["ep_pos"].index_select(0, indices)
+        oldest = self.cursor if self.count >= self.capacity else 0
+        age = (indices - oldest) % self.capacity
+        return (ep_pos > 0) & (ep_pos.clamp(max=self.frames) <= age)
+
+    def stack(self, indices: torch.Tensor, ep_pos: torch.Tensor) -> torch.Tensor:
+        """Gathers `frames` frames ending at each index, zeroing the ones before the episode"""
+        back = torch.arange(self.frames - 1, -1, -1)
+        frame_indices = (indices.view(-1, 1) - back) % self.capacity
+        missing = back > ep_pos.view(-1, 1)
+
+        x = self.storage.read(frame_indices.flatten(), ["frame"], self.pin_memory)["frame"]
+        x = x.view(len(indices), self.frames, *x.size()[1:])
+        x.masked_fill_(missing.view(*missing.size(), *([1] * (x.dim() - 2))), 0)
+        return x.flatten(1, 2)
+
+    def state_dict(self) -> dict:
+        x = super().state_dict()
+        x["ep_step"] = self.ep_step
+        x["new_episode"] = self.new_episode
+        return x
+
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        self.ep_step = state["ep_step"]
+        self.new_episode = state["new_episode"]
+        self.padding = int((self.storage.fields["ep_pos"][:self.count] == 0).sum()) if self.count else 0
+
+    def serialize(self) -> dict:
+        x = super().serialize()
+        x["frames"] = self.frames
+        return x
+
+class MemmapReplayBuffer(ReplayBuffer):
+
+    def __init__(
+        self,
+        capacity: int,
+        device: torch.device,
+        path: str,
+        obs_dtype: torch.dtype = None,
+        dtypes: dict[str, torch.dtype] = None
+    ) -> None:
+        """
+        Replay buffer kept in memory-mapped files under `path`, one file per field.
+        The OS page cache decides what stays in RAM, so capacity is bounded by disk instead.
+        Opening an existing `path` picks up the rows written before, e.g. after a crash.
+        """
+        super().__init__(capacity, device, obs_dtype, dtypes)
+        self.path = path
+        self.storage = MemmapStorage(path, capacity, self.storage.dtypes)
+
+        # cursor and count, mapped as well so they survive with the data
+        self.header = torch.from_file(os.path.join(path, "header.bin"), shared=True, size=2, dtype=torch.int64)
+        self.cursor, self.count = self.header.tolist()
+
+    def write(self, rows: dict[str, torch.Tensor]) -> int:
+        i = super().write(rows)
+        self.header[0] = self.cursor
+        self.header[1] = self.count
+        return i
+
+    def sample_indices(self, count: int) -> torch.Tensor:
+        """Sorted, so the pages are read front to back"""
+        return super().sample_indices(count).sort().values
+
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        self.header[0] = self.cursor
+        self.header[1] = self.count
+
+    def serialize(self) -> dict:
+        x = super().serialize()
+        x["path"] = self.path
+        return x
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+
+    def __init__(
+        self,
+        capacity: int,
+        device: torch.device,
+        alpha: float = 0.6,
+        beta: float = 0.4,
+        eps: float = 1e-6,
+        obs_dtype: torch.dtype = None,
+        dtypes: dict[str, torch.dtype] = None,
+        codec: Codec = None,
+        n_step: int = 1,
+        gamma: float = None
+    ) -> None:
+        """
+        Proportional prioritized replay (Schaul et al.)
+        Rows are sampled with probability p^alpha / sum(p^alpha), and batches carry
+        importance-sampling `weights` (normalized by the largest one) and their `indices`,
+        so the trainer can push TD errors back through `update_priorities`.
+
+        New rows get the highest priority seen so far. They are queued and
+        added to the trees in one batched update when the next sample is drawn.
+        """
+        super().__init__(capacity, device, obs_dtype, dtypes, codec, n_step, gamma)
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.sum_tree = SumTree(capacity)
+        self.min_tree = MinTree(capacity)
+        self.max_priority = 1.0
+        self.pending : list[int] = []
+
+    def write(self, rows: dict[str, torch.Tensor]) -> int:
+        i = super().write(rows)
+        n = next(iter(rows.values())).size(0)
+        self.pending.extend((i + j) % self.capacity for j in range(n))
+        return i
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        indices = torch.tensor(self.pending)
+        self.pending.clear()
+        p = torch.full(indices.size(), self.max_priority ** self.alpha)
+        self.sum_tree.update(indices, p)
+        self.min_tree.update(indices, p)
+
+    def sample_indices(self, count: int) -> torch.Tensor:
+        """Stratified, one draw from each of `count` equal slices of the total"""
+        self.flush()
+        segment = self.sum_tree.total() / count
+        values = (torch.arange(count) + torch.rand(count)) * segment
+        return self.sum_tree.find(values).clamp_(max=len(self) - 1)
+
+    def sample(self, count: int) -> TransitionBatch:
+        with self.lock:
+            indices = self.sample_indices(count)
+            x = self.gather(indices)
+            x.indices = indices
+            x.weights = self.weights(indices).to(self.device)
+            return x
+
+    def weights(self, indices: torch.Tensor) -> torch.Tensor:
+        # (N * P(i))^-beta / max_j (N * P(j))^-beta, N and the total cancel out
+        p = self.sum_tree[indices]
+        w = (p / self.min_tree.min()) ** -self.beta
+        return w.float().view(-1, 1)
+
+    def update_priorities(self, indices: torch.Tensor, priorities: torch.Tensor) -> None:
+        priorities = priorities.detach().flatten().abs().double().cpu() + self.eps
+        p = priorities ** self.alpha
+        with self.lock:
+            self.flush()
+            self.max_priority = max(self.max_priority, priorities.max().item())
+            self.sum_tree.update(indices, p)
+            self.min_tree.update(indices, p)
+
+    def state_dict(self) -> dict:
+        self.flush()
+        x = super().state_dict()
+        x["sum_tree"] = self.sum_tree.tree
+        x["min_tree"] = self.min_tree.tree
+        x["max_priority"] = self.max_priority
+        return x
+
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        self.sum_tree.tree = state["sum_tree"]
+        self.min_tree.tree = state["min_tree"]
+        self.max_priority = state["max_priority"]
+        self.pending.clear()
+
+    def serialize(self) -> dict:
+        x = super().serialize()
+        x["alpha"] = self.alpha
+        x["beta"] = self.beta
+        return x
 
 if __name__ == "__main__":
-    transition = Transition(
-        torch.rand((0, 4, 4)),
-        torch.rand((0, 4)),
-        torch.rand((0, 1)),
-        torch.rand((0, 4, 4)),
-        torch.rand((0, 1))
-    )
-    b = ReplayBuffer(10,transition )
+    b = ReplayBuffer(10, torch.device("cpu"))
 
     for i in range(20):
 
-        transition = Transition(
+        transition = TransitionBatch(
             torch.rand((1, 4, 4)),
-            torch.rand((1, 4)),
+            torch.randint(0, 4, (1, 1)),
             torch.rand((1, 1)),
             torch.rand((1, 4, 4)),
-            torch.rand((1, 1))
+            torch.rand((1, 1)) > 0.5
         )
 
         b.push(transition)
@@ -1,24 +1,39 @@
-from agent import Agent
+from agent import Agent, InferenceEngine
 from strategy import EpsilonGreedy
 from environment import ALE
 from trainer import Trainer, OffPolicyTrainer
-from replay_buffer import ReplayBuffer, Transition
+from replay_buffer import FrameReplayBuffer, TransitionBatch
+from prefetcher import Prefetcher
 from architecture import Network
 import torch
-import torchvision.transforms as tf
 import preprocessing as prep
 from recorder import Recorder
-from plotter import Plotter
+from plotter import PlotterProcess
+from checkpoint import Checkpointer
+from profiler import PROFILER
 
 import os
 os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
 
+def make_env(frameskip: int, img_size: int, frames: int, device: torch.device) -> ALE:
+    return ALE(
+        "ALE/Breakout-v5", 
+        frameskip,
+        device,
+        [
+            prep.FusedFrame((img_size, img_size)),
+            prep.AddBatchDim(),
+            prep.MultiFrame(frames)
+        ]
+    )
+
 if __name__ == "__main__":
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     cpu = torch.device("cpu")
 
-    capacity = 100000000
+    capacity = 100000
     batch_size = 64
+    prefetch = 2
     gamma = 0.999
     start = 0.9
     end = 0.05
@@ -29,56 +44,69 @@ if __name__ == "__main__":
     record_interval = 50
     plot_interval = 150
     plot_path = "hi.png"
+    history_path = "history.jsonl"
+    checkpoint_path = "checkpoints"
+    checkpoint_interval = 50000
     img_size = 84
     frameskip = 4
     frames = 3
+    autocast = None # torch.bfloat16 on CPUs with fast bf16 convolutions
+    profile = False
+    profile_interval = 10000
+    profile_summary_path = "profile.json"
+    profile_trace_path = "trace.json" # open in chrome://tracing or Perfetto
 
     steps_per_update = 20
     swap_interval = 5 * steps_per_update
 
-    env = ALE(
-        "ALE/Breakout-v5", 
-        frameskip,
-        device,
-        [
-            prep.WrappedProcessing(tf.ToPILImage()),
-            prep.ToTensor(),
-            prep.Resize((img_size, img_size)),
-            prep.Grayscale(),
-            prep.AddBatchDim(),
-            prep.MultiFrame(frames)
-        ]
-    )
+    env = make_env(frameskip, img_size, frames, device)
 
     input_size, output_size = env.size()
 
-    buffer = ReplayBuffer(capacity, device)
+    buffer = FrameReplayBuffer(capacity, device, frames, obs_dtype=torch.uint8)
 
-    network = Network(input_size, output_size, device)
+    network = Network(input_size, output_size, device, autocast)
     strategy = EpsilonGreedy(start, end, decay_steps)
-    agent = Agent(network, strategy)
+    agent = Agent(network, strategy, InferenceEngine(network))
     optimizer = torch.optim.Adam(network.parameters())
     trainer = OffPolicyTrainer(
         swap_interval,
-        buffer, 
+        Prefetcher(buffer, batch_size, prefetch), 
         network, 
         optimizer, 
         batch_size, 
         gamma,
-        steps_per_update=steps_per_update
+        steps_per_update=steps_per_update,
+        autocast=autocast
     )
-    recorder = Recorder(mean_duration, record_interval)
-    plotter = Plotter()
+    recorder = Recorder(mean_duration, record_interval, path=history_path)
+    plotter = PlotterProcess(plot_path)
     
     losses = []
 
     agent.reset()
+    trainer.listen(agent.refresh)
     trainer.reset()
     recorder.on_game_reset()
 
+    if profile:
+        PROFILER.enable()
+
+    checkpointer = Checkpointer(checkpoint_path)
+    first_episode = 0
     steps = 0
-    for episode in range(total_episodes):
+    if checkpointer.latest() is not None:
+        state = checkpointer.load()
+        trainer.load_state_dict(state["trainer"])
+        strategy.load_state_dict(state["strategy"])
+        recorder.load_state_dict(state["recorder"])
+        buffer.load_state_dict(state["buffer"])
+        first_episode, steps = state["episode"], state["steps"]
+        agent.refresh()
+
+    for episode in range(first_episode, total_episodes):
         state = env.reset()
+        buffer.ep_reset()
 
         for i_episode in range(max_steps_per_episode):
             steps +=1
@@ -86,19 +114,32 @@ if __name__ == "__main__":
             action = agent.step(state)
             
             next_state, r, done = env.step(action)
-            buffer.push(Transition(state, action, r, next_state, done))
+            with PROFILER.section("buffer.push"):
+                buffer.push(TransitionBatch(state, action, r, next_state, done))
             state = next_state
             loss = trainer.step()
 
-            recorder.step(r.item(), loss.item())
+            recorder.step(r, loss)
 
             if steps % plot_interval == 0:
-                plotter.plot(*recorder.data())
-                plotter.save(plot_path)
+                plotter.extend(*recorder.new_data())
+
+            if PROFILER.enabled and steps % profile_interval == 0:
+                PROFILER.save(profile_summary_path, profile_trace_path)
+
+            if steps % checkpoint_interval == 0:
+                checkpointer.save(steps, {
+                    "trainer": trainer,
+                    "strategy": strategy,
+                    "recorder": recorder,
+                    "buffer": buffer,
+                    "episode": episode,
+                    "steps": steps
+                }, pause=[trainer.buffer])
 
             if done.item():
                 break
         
-        recorder.ep_duration.append(i_episode)
-                
-    
+        recorder.on_episode_end(i_episode)
+
+    checkpointer.wait()
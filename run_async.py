@@ -0,0 +1,98 @@
+from strategy import EpsilonGreedy
+from actor_learner import SharedWeights, Learner, start_actors
+from trainer import OffPolicyTrainer
+from replay_buffer import ReplayBuffer
+from prefetcher import Prefetcher
+from architecture import Network
+from recorder import Recorder
+from plotter import PlotterProcess
+from run import make_env
+from agent import InferenceEngine
+from functools import partial
+import torch
+import torch.multiprocessing as mp
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+def make_strategy(start: float, end: float, decay_steps: int, i: int) -> EpsilonGreedy:
+    return EpsilonGreedy(start, end, decay_steps)
+
+if __name__ == "__main__":
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    cpu = torch.device("cpu")
+
+    actors = 4
+    chunk = 64
+    sync_interval = 100
+    publish_interval = 10
+    capacity = 100000
+    batch_size = 64
+    prefetch = 2
+    gamma = 0.999
+    n_step = 3
+    start = 0.9
+    end = 0.05
+    decay_steps = 100000
+    total_steps = 1000000
+    mean_duration = 100
+    report_interval = 1000
+    plot_path = "hi.png"
+    history_path = "history.jsonl"
+    img_size = 84
+    frameskip = 4
+    frames = 3
+    quantize = False # actors act with an int8 copy of the network
+
+    steps_per_update = 1
+    swap_interval = 100
+
+    env_fn = partial(make_env, frameskip, img_size, frames, cpu)
+    input_size, output_size = env_fn().size()
+    network_fn = partial(Network, input_size, output_size, cpu)
+
+    buffer = ReplayBuffer(capacity, device, obs_dtype=torch.uint8)
+    network = Network(input_size, output_size, device)
+    optimizer = torch.optim.Adam(network.parameters())
+    trainer = OffPolicyTrainer(
+        swap_interval,
+        Prefetcher(buffer, batch_size, prefetch),
+        network,
+        optimizer,
+        batch_size,
+        gamma,
+        steps_per_update=steps_per_update
+    )
+
+    weights = SharedWeights(network)
+    transitions = mp.Queue(maxsize=4 * actors)
+    processes = start_actors(
+        actors,
+        env_fn,
+        network_fn,
+        partial(make_strategy, start, end, decay_steps),
+        weights,
+        transitions,
+        chunk,
+        sync_interval,
+        n_step,
+        gamma,
+        partial(InferenceEngine, quantize=quantize)
+    )
+
+    learner = Learner(trainer, transitions, weights, publish_interval)
+    recorder = Recorder(mean_duration, report_interval, path=history_path)
+    plotter = PlotterProcess(plot_path)
+    recorder.on_game_reset()
+
+    for steps in range(1, total_steps + 1):
+        loss = learner.step()
+
+        if steps % report_interval == 0:
+            stats = learner.stats()
+            print(steps, stats)
+            recorder.record(stats["mean_return"], loss.item())
+            plotter.extend(*recorder.new_data())
+
+    for process in processes:
+        process.terminate()
@@ -0,0 +1,111 @@
+from agent import Agent, InferenceEngine
+from strategy import EpsilonGreedy
+from replay_buffer import FrameReplayBuffer, TransitionBatch
+from prefetcher import Prefetcher
+from architecture import Network
+from recorder import Recorder
+from plotter import PlotterProcess
+from parallel import init, DataParallelTrainer
+from run import make_env
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+"""
+One process per rank, each with its own environment and buffer.
+On one machine `python run_parallel.py` spawns `world_size` ranks.
+Across nodes, launch with `torchrun --nnodes N --nproc_per_node K run_parallel.py`
+"""
+
+def main(rank: int = None, world_size: int = None) -> None:
+    init(rank, world_size)
+    rank = dist.get_rank()
+    torch.manual_seed(rank)
+    torch.set_num_threads(1)
+    device = torch.device("cpu")
+
+    capacity = 100000
+    batch_size = 256
+    prefetch = 2
+    gamma = 0.999
+    start = 0.9
+    end = 0.05
+    decay_steps = 100000
+    total_episodes = 10000
+    max_steps_per_episode = 5000
+    mean_duration = 100
+    record_interval = 50
+    plot_interval = 150
+    plot_path = "hi.png"
+    history_path = "history.jsonl"
+    img_size = 84
+    frameskip = 4
+    frames = 3
+
+    steps_per_update = 20
+    swap_interval = 5 * steps_per_update
+
+    env = make_env(frameskip, img_size, frames, device)
+
+    input_size, output_size = env.size()
+
+    buffer = FrameReplayBuffer(capacity, device, frames, obs_dtype=torch.uint8)
+
+    network = Network(input_size, output_size, device)
+    strategy = EpsilonGreedy(start, end, decay_steps)
+    agent = Agent(network, strategy, InferenceEngine(network))
+    optimizer = torch.optim.Adam(network.parameters())
+    trainer = DataParallelTrainer(
+        swap_interval,
+        Prefetcher(buffer, batch_size // dist.get_world_size(), prefetch),
+        network,
+        optimizer,
+        batch_size,
+        gamma,
+        steps_per_update=steps_per_update
+    )
+    recorder = Recorder(mean_duration, record_interval, path=history_path if rank == 0 else None)
+    plotter = PlotterProcess(plot_path) if rank == 0 else None
+
+    agent.reset()
+    trainer.listen(agent.refresh)
+    trainer.reset()
+    recorder.on_game_reset()
+
+    # Every rank takes the same number of steps, trainer.step is a collective
+    steps = 0
+    state = env.reset()
+    buffer.ep_reset()
+    ep_steps = 0
+    for steps in range(1, total_episodes * max_steps_per_episode + 1):
+        ep_steps += 1
+
+        action = agent.step(state)
+
+        next_state, r, done = env.step(action)
+        buffer.push(TransitionBatch(state, action, r, next_state, done))
+        state = next_state
+        loss = trainer.step()
+
+        recorder.step(r, loss)
+
+        if plotter is not None and steps % plot_interval == 0:
+            plotter.extend(*recorder.new_data())
+
+        if done.item() or ep_steps == max_steps_per_episode:
+            recorder.on_episode_end(ep_steps)
+            state = env.reset()
+            buffer.ep_reset()
+            ep_steps = 0
+
+    dist.destroy_process_group()
+
+if __name__ == "__main__":
+    world_size = 4
+    if "RANK" in os.environ:
+        main()
+    else:
+        mp.spawn(main, args=(world_size,), nprocs=world_size)
@@ -0,0 +1,89 @@
+from agent import Agent, InferenceEngine
+from strategy import EpsilonGreedy
+from environment import VectorEnvironment
+from trainer import OffPolicyTrainer
+from replay_buffer import ReplayBuffer, TransitionBatch
+from prefetcher import Prefetcher
+from architecture import Network
+from recorder import Recorder
+from plotter import PlotterProcess
+from run import make_env
+from functools import partial
+import torch
+
+import os
+os.environ["KMP_DUPLICATE_LIB_OK"]="TRUE"
+
+if __name__ == "__main__":
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    cpu = torch.device("cpu")
+
+    envs = 8
+    capacity = 100000
+    batch_size = 64
+    prefetch = 2
+    gamma = 0.999
+    start = 0.9
+    end = 0.05
+    decay_steps = 100000
+    total_steps = 10000000
+    mean_duration = 100
+    record_interval = 50
+    plot_interval = 150
+    plot_path = "hi.png"
+    history_path = "history.jsonl"
+    img_size = 84
+    frameskip = 4
+    frames = 3
+
+    steps_per_update = 20
+    swap_interval = 5 * steps_per_update
+
+    env = VectorEnvironment([partial(make_env, frameskip, img_size, frames, cpu) for _ in range(envs)], device)
+
+    input_size, output_size = env.size()
+
+    buffer = ReplayBuffer(capacity, device, obs_dtype=torch.uint8)
+
+    network = Network(input_size, output_size, device)
+    strategy = EpsilonGreedy(start, end, decay_steps)
+    agent = Agent(network, strategy, InferenceEngine(network))
+    optimizer = torch.optim.Adam(network.parameters())
+    trainer = OffPolicyTrainer(
+        swap_interval,
+        Prefetcher(buffer, batch_size, prefetch),
+        network,
+        optimizer,
+        batch_size,
+        gamma,
+        steps_per_update=steps_per_update
+    )
+    recorder = Recorder(mean_duration, record_interval, path=history_path)
+    plotter = PlotterProcess(plot_path)
+
+    agent.reset()
+    trainer.listen(agent.refresh)
+    trainer.reset()
+    recorder.on_game_reset()
+
+    state = env.reset()
+    durations = torch.zeros(envs, dtype=torch.long)
+    for steps in range(1, total_steps + 1):
+        # Every call acts, steps and pushes for all environments at once
+        action = agent.step(state)
+
+        next_state, r, done = env.step(action)
+        buffer.push(TransitionBatch(state, action, r, next_state, done))
+        state = next_state
+        loss = trainer.step()
+
+        recorder.step(r, loss)
+
+        durations += 1
+        ended = done.flatten().cpu()
+        for duration in durations[ended].tolist():
+            recorder.on_episode_end(duration)
+        durations[ended] = 0
+
+        if steps % plot_interval == 0:
+            plotter.extend(*recorder.new_data())
@@ -0,0 +1,70 @@
+import torch
+
+
+class SegmentTree:
+    """
+    Array-backed binary tree over `capacity` leaves.
+    Node `i` has children `2i` and `2i + 1`, the root is 1 and leaves start at `size`.
+    Updates and queries take a batch of indices and walk the tree one level at a time,
+    so a batch costs O(log n) vectorized ops instead of a Python loop per index.
+    """
+
+    neutral = 0.0
+
+    def __init__(self, capacity: int) -> None:
+        size = 1
+        while size < capacity:
+            size *= 2
+        self.size = size
+        self.depth = size.bit_length() - 1
+        self.tree = torch.full((2 * size,), self.neutral, dtype=torch.float64)
+
+    def op(self, left: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+        raise NotImplementedError
+
+    def update(self, indices: torch.Tensor, values: torch.Tensor) -> None:
+        nodes = indices + self.size
+        self.tree[nodes] = values.to(self.tree.dtype)
+        for _ in range(self.depth):
+            nodes = torch.unique(nodes // 2)
+            self.tree[nodes] = self.op(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def __getitem__(self, indices: torch.Tensor) -> torch.Tensor:
+        return self.tree[indices + self.size]
+
+    def root(self) -> float:
+        return self.tree[1].item()
+
+
+class SumTree(SegmentTree):
+
+    neutral = 0.0
+
+    def op(self, left: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+        return left + right
+
+    def total(self) -> float:
+        return self.root()
+
+    def find(self, values: torch.Tensor) -> torch.Tensor:
+        """For each value, the leaf whose prefix sum range contains it"""
+        values = values.to(self.tree.dtype)
+        nodes = torch.ones_like(values, dtype=torch.long)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            right = values > left_sum
+            values = torch.where(right, values - left_sum, values)
+            nodes = left + right
+        return nodes - self.size
+
+
+class MinTree(SegmentTree):
+
+    neutral = float("inf")
+
+    def op(self, left: torch.Tensor, right: torch.Tensor) -> torch.Tensor:
+        return torch.minimum(left, right)
+
+    def min(self) -> float:
+        return self.root()
@@ -15,26 +15,35 @@ class EpsilonGreedy(Strategy):
 
         self.slope = (end-start)/decay_steps
 
-    def select(self, q: Q) -> Action:
+    def select(self, q: Q, explore: torch.Tensor = None) -> Action:
         """
         If multiple action dimension, run this for each dimension
         """
         size = q.size()
         batch_size = size[0]
         action_count = size[-1]
-        mask = torch.rand(batch_size) <= self.epsilon
+        mask = self.explore(batch_size, q.device) if explore is None else explore
 
         a = q.argmax(dim=1)
-        a[mask] = torch.randint(0, action_count, (batch_size,))
+        a = torch.where(mask, torch.randint(0, action_count, (batch_size,), device=q.device), a)
 
         return a
 
+    def explore(self, batch_size: int, device: torch.device = None) -> torch.Tensor:
+        return torch.rand(batch_size, device=device) <= self.epsilon
+
     def reset(self) -> None:
         self.current_step = 0
 
     def step(self) -> None:
         self.current_step += 1
 
+    def state_dict(self) -> dict:
+        return {"current_step": self.current_step}
+
+    def load_state_dict(self, state: dict) -> None:
+        self.current_step = state["current_step"]
+
     @property
     def epsilon(self) -> float:
         return max(self.start + self.slope * self.current_step, self.end)
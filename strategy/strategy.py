@@ -2,9 +2,18 @@ from abc import abstractmethod
 from serializable import Serializable
 from base import Base
 from my_types import Q, Action
+import torch
 
 class Strategy(Base, Serializable):
 
     @abstractmethod
-    def select(self, q: Q) -> Action:
+    def select(self, q: Q, explore: torch.Tensor = None) -> Action:
+        """`explore` comes from `explore` when it was drawn ahead"""
         raise NotImplementedError
+
+    def explore(self, batch_size: int, device: torch.device = None) -> torch.Tensor:
+        """
+        Rows that will ignore q, drawn before the forward so it can be skipped for them.
+        Pass the result on to `select`
+        """
+        return torch.zeros(batch_size, dtype=torch.bool, device=device)
@@ -0,0 +1,46 @@
+import torch
+from architecture import Network
+
+
+class TargetNetwork:
+
+    def __init__(self, network: Network, tau: float = None) -> None:
+        """
+        One persistent eval-mode copy of `network`, updated in place.
+        `sync` copies the weights over, `update` moves them `tau` of the way (Polyak averaging).
+        Both run as a few foreach ops over all tensors instead of rebuilding the module.
+        Targets are always computed in float32, even if `network` autocasts,
+        since bf16 can't resolve small differences between large q values.
+        """
+        self.source = network
+        self.tau = tau
+        self.network = network.copy()
+        self.network.autocast = None
+        self.network.eval()
+        self.network.requires_grad_(False)
+
+        self.params = list(self.network.parameters())
+        self.source_params = list(network.parameters())
+        floats = [
+            (t, s) for t, s in zip(self.network.buffers(), network.buffers())
+            if t.is_floating_point()
+        ]
+        self.float_buffers = [t for t, _ in floats]
+        self.source_float_buffers = [s for _, s in floats]
+        self.buffers = list(self.network.buffers())
+        self.source_buffers = list(network.buffers())
+
+    @torch.no_grad()
+    def sync(self) -> None:
+        torch._foreach_copy_(self.params, self.source_params)
+        torch._foreach_copy_(self.buffers, self.source_buffers)
+
+    @torch.no_grad()
+    def update(self) -> None:
+        torch._foreach_lerp_(self.params, self.source_params, self.tau)
+        if self.float_buffers:
+            torch._foreach_lerp_(self.float_buffers, self.source_float_buffers, self.tau)
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        with torch.inference_mode():
+            return self.network(x)
@@ -1,9 +1,13 @@
-from replay_buffer import ReplayBuffer, Transition
+from replay_buffer import ReplayBuffer, TransitionBatch
 from architecture import Network
+from target_network import TargetNetwork
 from base import Base
 import torch
 from my_types import State, Reward, Done
+from typing import Callable
 import torch.nn.functional as F
+from util import compiled, autocast
+from profiler import PROFILER, profiled
 
 class Trainer(Base):
     """On-Policy is the base trainer"""
@@ -15,49 +19,112 @@ class Trainer(Base):
         optimizer: torch.optim.Optimizer,
         batch_size: int,
         gamma: float,
-        steps_per_update: int
+        steps_per_update: int,
+        compile: bool = False,
+        autocast: torch.dtype = None
     ):
+        """
+        With `compile`, the whole gradient step in `update` goes through `torch.compile`,
+        running eager if that isn't available.
+        With `autocast` (e.g. torch.bfloat16), the forward pass for the prediction runs in that dtype
+        while weights, gradients, targets and the loss stay float32.
+        """
         self.buffer = replay_buffer
         self.nn = network
         self.optim = optimizer
         self.bs = batch_size
         self.gamma = gamma
         self.steps_per_update = steps_per_update
+        self.params = list(network.parameters())
+        self.autocast = autocast
+        self.updates = 0
+        self.listeners : list[Callable[[], None]] = []
+        if compile:
+            self.update = compiled(self.update)
 
     def step(self) -> torch.Tensor:
         loss = self.train()
         self.steps += 1
         return loss
     
+    @profiled("trainer.train")
     def train(self) -> torch.FloatTensor:
         if self.steps % self.steps_per_update != 0:
             return torch.FloatTensor([0])
 
-        if len(self.buffer) < self.bs:
+        if not self.is_full():
             return torch.FloatTensor([0])
         
-        s_now, a, r, s_next, done = self.buffer.sample(self.bs)
+        with PROFILER.section("buffer.sample"):
+            batch = self.buffer.sample(self.bs)
+        with PROFILER.section("trainer.update"):
+            loss, td = self.update(batch)
 
-        prediction_temp = self.nn(s_now)
-        prediction = prediction_temp.gather(1, a)
-        target = self.target(r, s_next, done).detach()
+        if batch.indices is not None:
+            self.buffer.update_priorities(batch.indices, td)
 
-        loss = F.smooth_l1_loss(prediction, target)
+        self.updates += 1
+        for listener in self.listeners:
+            listener()
+        return loss
+
+    def update(self, batch: TransitionBatch) -> tuple[torch.Tensor, torch.Tensor]:
+        """One gradient step on `batch`, returns the loss and the TD errors"""
+        s_now, a, r, s_next, done = batch.tuple()
+
+        with autocast(self.nn.device, self.autocast):
+            prediction_temp = self.nn(s_now)
+        prediction = prediction_temp.float().gather(1, a)
+        target = self.target(r, s_next, done, batch.discount).detach()
+
+        if batch.weights is None:
+            loss = F.smooth_l1_loss(prediction, target)
+        else:
+            loss = (batch.weights * F.smooth_l1_loss(prediction, target, reduction="none")).mean()
 
         self.optim.zero_grad()
         loss.backward()
-        for param in self.nn.parameters():
-            param.grad.data.clamp_(-1, 1)
+        self.reduce_gradients()
+        torch.nn.utils.clip_grad_value_(self.params, 1, foreach=True)
         self.optim.step()
+        self.on_update()
 
-        return loss
+        return loss, (target - prediction).detach()
     
-    def target(self, r:Reward, s_next: State, done: Done) -> torch.Tensor:
-        target = r + done.logical_not() * self.gamma * self.nn(s_next).max()
+    def target(self, r:Reward, s_next: State, done: Done, discount: torch.Tensor = None) -> torch.Tensor:
+        """`discount` comes with n-step transitions, and already has `done` in it"""
+        if discount is None:
+            discount = done.logical_not() * self.gamma
+        target = r + discount * self.nn(s_next).max()
         return target
 
+    def reduce_gradients(self) -> None:
+        """Single process has nothing to reduce"""
+        pass
+
+    def on_update(self) -> None:
+        """Called after every optimizer step, inside `update`, so compiled along with it"""
+        pass
+
+    def listen(self, listener: Callable[[], None]) -> None:
+        """Calls `listener` after every gradient step, outside of `update`, e.g. `Agent.refresh`"""
+        self.listeners.append(listener)
+
     def reset(self) -> None:
         self.steps = 0
+        self.updates = 0
+
+    def state_dict(self) -> dict:
+        return {
+            "steps": self.steps,
+            "network": self.nn.state_dict(),
+            "optimizer": self.optim.state_dict()
+        }
+
+    def load_state_dict(self, state: dict) -> None:
+        self.steps = state["steps"]
+        self.nn.load_state_dict(state["network"])
+        self.optim.load_state_dict(state["optimizer"])
 
     def is_full(self) -> bool:
         return len(self.buffer) >= self.bs
@@ -72,22 +139,73 @@ class OffPolicyTrainer(Trainer):
         optimizer: torch.optim.Optimizer,
         batch_size: int,
         gamma: float,
-        steps_per_update: int
+        steps_per_update: int,
+        tau: float = None,
+        compile: bool = False,
+        autocast: torch.dtype = None
     ):
-        super().__init__(replay_buffer, network, optimizer, batch_size, gamma, steps_per_update)
+        """
+        Target network is synced every `swap_interval` steps,
+        or with `tau`, moved `tau` towards the network after every update instead
+        """
+        super().__init__(replay_buffer, network, optimizer, batch_size, gamma, steps_per_update, compile, autocast)
 
         self.swap_interval = swap_interval
-        self.target_network : Network = network.copy()
+        self.target_network = TargetNetwork(network, tau)
     
     def step(self) -> torch.Tensor:
-        if self.steps % self.swap_interval == 0:
-            self.target_network = self.nn.copy()
-            self.target_network.eval()
+        if self.target_network.tau is None and self.steps % self.swap_interval == 0:
+            self.target_network.sync()
         loss = super().step()
         return loss
+
+    def on_update(self) -> None:
+        if self.target_network.tau is not None:
+            self.target_network.update()
+
+    def state_dict(self) -> dict:
+        x = super().state_dict()
+        x["target_network"] = self.target_network.network.state_dict()
+        return x
+
+    def load_state_dict(self, state: dict) -> None:
+        super().load_state_dict(state)
+        self.target_network.network.load_state_dict(state["target_network"])
     
-    def target(self, r:Reward, s_next: State, done: Done) -> torch.Tensor:
+    def target(self, r:Reward, s_next: State, done: Done, discount: torch.Tensor = None) -> torch.Tensor:
+        if discount is None:
+            discount = done.logical_not() * self.gamma
         q : torch.Tensor = self.target_network(s_next)
         q_max = torch.max(q, dim=1).values.view(-1, 1)
-        target = r + done.logical_not() * self.gamma * q_max
+        target = r + discount * q_max
         return target
+
+if __name__ == "__main__":
+    # bf16 autocast should train to about the same losses as float32
+    cpu = torch.device("cpu")
+    input_size = torch.Size([1, 3, 40, 40])
+    torch.manual_seed(0)
+    buffer = ReplayBuffer(256, cpu)
+    for _ in range(256):
+        buffer.push(TransitionBatch(
+            torch.rand(input_size), torch.randint(0, 4, (1, 1)), torch.rand(1, 1),
+            torch.rand(input_size), torch.rand(1, 1) < 0.05
+        ))
+    init = Network(input_size, 4, cpu)
+
+    losses = {}
+    for dtype in [None, torch.bfloat16]:
+        torch.manual_seed(1)
+        network = init.copy()
+        # Only the trainer gets the dtype, the network follows the trainer's autocast
+        conv_dtypes = set()
+        network.conv1.register_forward_hook(lambda module, inputs, output: conv_dtypes.add(output.dtype))
+        trainer = OffPolicyTrainer(10, buffer, network, torch.optim.Adam(network.parameters()), 32, 0.99, 1, autocast=dtype)
+        trainer.reset()
+        losses[dtype] = torch.stack([trainer.step() for _ in range(50)])
+        assert conv_dtypes == {dtype or torch.float32}, conv_dtypes
+
+    fp32, bf16 = losses[None], losses[torch.bfloat16]
+    diff = ((fp32 - bf16).abs() / fp32.abs()).mean().item()
+    print(f"fp32 {fp32.mean().item():.5f} bf16 {bf16.mean().item():.5f} mean relative difference {diff:.4f}")
+    assert diff < 0.05
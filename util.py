@@ -1,4 +1,54 @@
+import contextlib
 import torch
+import warnings
 
 def conv2d_output_size(size : torch.Tensor, kernel_size, stride) -> int:
     return torch.div((size - (kernel_size - 1) - 1) , stride, rounding_mode='floor') + 1
+
+def autocast(device: torch.device, dtype: torch.dtype = None) -> torch.autocast | contextlib.nullcontext:
+    """
+    Autocast to `dtype` on `device`, or no context at all when `dtype` is None,
+    so whatever autocast the caller is in still applies
+    """
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype)
+
+def compile_errors() -> tuple[type, ...]:
+    """What `torch.compile` raises when it can't compile, as opposed to errors in the function itself"""
+    try:
+        import torch._dynamo.exc as exc
+    except ImportError:
+        return ()
+    names = ["BackendCompilerFailed", "Unsupported", "InternalTorchDynamoError"]
+    return tuple(getattr(exc, name) for name in names if hasattr(exc, name))
+
+def compiled(fn):
+    """
+    `torch.compile`d `fn`, falling back to plain `fn` when compilation isn't available.
+    Compilation happens on the first call, so compile errors there also switch back to eager for good.
+    Any other error, or any error after the first call, is raised as is.
+    """
+    if not hasattr(torch, "compile"):
+        return fn
+    try:
+        compiled_fn = torch.compile(fn)
+    except Exception as e:
+        warnings.warn(f"torch.compile unavailable, running eager: {e}")
+        return fn
+
+    errors = compile_errors()
+    current = [compiled_fn]
+    first = [True]
+    def call(*args, **kwargs):
+        if not first[0]:
+            return current[0](*args, **kwargs)
+        try:
+            out = current[0](*args, **kwargs)
+        except errors as e:
+            warnings.warn(f"torch.compile failed, running eager: {e}")
+            current[0] = fn
+            out = fn(*args, **kwargs)
+        first[0] = False
+        return out
+    return call